@@ -0,0 +1 @@
+"""Synthetic datasets and headless benchmarks of the dashboard pages."""
@@ -0,0 +1,53 @@
+"""Compare two bench.run result files.
+
+Prints, for every scale and page present in both, the change of the rerun
+latency percentiles, peak memory and mean payload. Exits with status 1 when
+a metric grew by more than --threshold percent, so it can gate a CI job.
+
+Usage: python -m bench.compare bench/results/<base>.json bench/results/<new>.json
+"""
+import argparse
+import json
+import sys
+from pathlib import Path
+
+METRICS = {
+    'p50 ms': lambda page: page['latency_ms']['p50'],
+    'p90 ms': lambda page: page['latency_ms']['p90'],
+    'peak MB': lambda page: page['peak_rss_mb'],
+    'payload KiB': lambda page: page['payload_bytes']['mean'] / 1024,
+}
+
+
+def compare(base, new, threshold):
+    """Rows of (scale, page, metric, base value, new value, change in %, regressed)."""
+    rows = []
+    for scale, scale_results in new['scales'].items():
+        for page, page_results in scale_results['pages'].items():
+            base_page = base['scales'].get(scale, {}).get('pages', {}).get(page)
+            if base_page is None:
+                continue
+            for metric, value in METRICS.items():
+                before, after = value(base_page), value(page_results)
+                change = 100 * (after - before) / before if before else 0.0
+                rows.append((scale, page, metric, before, after, change, change > threshold))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('base', type=Path)
+    parser.add_argument('new', type=Path)
+    parser.add_argument('--threshold', type=float, default=10, help='growth (in %%) reported as a regression')
+    args = parser.parse_args()
+
+    base, new = json.loads(args.base.read_text()), json.loads(args.new.read_text())
+    print(f'{str(base["commit"])[:12]} -> {str(new["commit"])[:12]}')
+    rows = compare(base, new, args.threshold)
+    for scale, page, metric, before, after, change, regressed in rows:
+        print(f'{scale:>5} {page:<28} {metric:<12} {before:10.1f} {after:10.1f} {change:+7.1f}%' + ('  REGRESSION' if regressed else ''))
+    sys.exit(1 if any(row[-1] for row in rows) else 0)
+
+
+if __name__ == '__main__':
+    main()
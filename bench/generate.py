@@ -0,0 +1,120 @@
+"""Synthetic df_combined_lego-shaped datasets for benchmarking.
+
+Scale 1 mimics the published dataset: about 11,000 sets released between 1950
+and 2017 (more of them every year), 140 parent themes, 460 themes and one row
+per (set, part, colour) with around 50 rows per set. Higher scales multiply
+the number of sets and part rows. Theme and part catalogues grow with the
+square root of the scale, and colours and part categories stay fixed, as they
+would in a larger catalogue.
+
+Usage: python -m bench.generate --scale 10 --out bench/data/lego_10x.csv
+"""
+import argparse
+import math
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+BASE = {'sets': 11_000, 'parent_themes': 140, 'themes': 460, 'parts': 25_000,
+        'rows_per_set': 50, 'colors': 135, 'part_categories': 57}
+FIRST_YEAR, LAST_YEAR = 1950, 2017
+# Sets written to the CSV per chunk
+CHUNK_SETS = 20_000
+
+
+def cardinalities(scale, base=BASE):
+    """Entity counts of a dataset scale times the size of base."""
+    grow = math.sqrt(scale)
+    return {
+        'sets': int(base['sets'] * scale),
+        'parent_themes': int(base['parent_themes'] * grow),
+        'themes': int(base['themes'] * grow),
+        'parts': int(base['parts'] * grow),
+        'rows_per_set': base['rows_per_set'],
+        'colors': base['colors'],
+        'part_categories': base['part_categories'],
+    }
+
+
+def _catalogues(counts, rng):
+    # Themes belong to parent themes with Zipf-like sizes; every parent theme has at least one theme
+    parent_weights = 1 / np.arange(1, counts['parent_themes'] + 1)
+    theme_parent = np.concatenate([
+        np.arange(counts['parent_themes']),
+        rng.choice(counts['parent_themes'], counts['themes'] - counts['parent_themes'], p=parent_weights / parent_weights.sum()),
+    ])
+    theme_weights = parent_weights[theme_parent] * rng.uniform(0.2, 1, len(theme_parent))
+    # Later years release exponentially more sets
+    years = np.arange(FIRST_YEAR, LAST_YEAR + 1)
+    year_weights = np.exp((years - FIRST_YEAR) / 12)
+    return {
+        'parent_theme_names': np.array([f'Parent Theme {i}' for i in range(counts['parent_themes'])], dtype=object),
+        'theme_names': np.array([f'Theme {i}' for i in range(counts['themes'])], dtype=object),
+        'theme_parent': theme_parent,
+        'theme_p': theme_weights / theme_weights.sum(),
+        'years': years,
+        'year_p': year_weights / year_weights.sum(),
+        'part_category': rng.integers(0, counts['part_categories'], counts['parts']),
+        # Common parts are used far more often than rare ones
+        'part_p': (w := 1 / np.arange(1, counts['parts'] + 1) ** 0.8) / w.sum(),
+    }
+
+
+def _chunk(first_set, n_sets, counts, catalogues, rng):
+    set_ids = np.arange(first_set, first_set + n_sets)
+    themes = rng.choice(len(catalogues['theme_names']), n_sets, p=catalogues['theme_p'])
+    years = rng.choice(catalogues['years'], n_sets, p=catalogues['year_p'])
+    # About one in ten set names is reused by another set (variants, re-releases)
+    name_ids = np.where(rng.random(n_sets) < 0.1, rng.integers(0, max(1, int(counts['sets'] * 0.9)), n_sets), set_ids)
+    rows_per_set = np.maximum(1, rng.lognormal(math.log(counts['rows_per_set']) - 0.5, 1.0, n_sets).astype(int))
+
+    row_set = np.repeat(np.arange(n_sets), rows_per_set)
+    parts = rng.choice(counts['parts'], len(row_set), p=catalogues['part_p'])
+    quantity = np.minimum(rng.geometric(0.35, len(row_set)), 100)
+    num_parts = np.bincount(row_set, weights=quantity, minlength=n_sets).astype(int)
+
+    return pd.DataFrame({
+        'set_num': pd.Series(set_ids[row_set]).astype(str) + '-1',
+        'set_name': 'Set ' + pd.Series(name_ids[row_set]).astype(str),
+        'year': years[row_set],
+        'theme_name': catalogues['theme_names'][themes[row_set]],
+        'parent_theme_name': catalogues['parent_theme_names'][catalogues['theme_parent'][themes[row_set]]],
+        'num_parts': num_parts[row_set],
+        'part_num': 'p' + pd.Series(parts).astype(str),
+        'part_name': 'Part ' + pd.Series(parts).astype(str),
+        'part_category_name': 'Category ' + pd.Series(catalogues['part_category'][parts]).astype(str),
+        'quantity': quantity,
+        'color_name': 'Color ' + pd.Series(rng.integers(0, counts['colors'], len(row_set))).astype(str),
+        'is_trans': np.where(rng.random(len(row_set)) < 0.08, 't', 'f'),
+    })
+
+
+def generate(path, scale=1, seed=0, base=BASE):
+    """Write a synthetic dataset scale times the size of base to the CSV at path; return its number of rows."""
+    rng = np.random.default_rng(seed)
+    counts = cardinalities(scale, base)
+    catalogues = _catalogues(counts, rng)
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    n_rows = 0
+    with open(path, 'w', newline='') as f:
+        for first_set in range(0, counts['sets'], CHUNK_SETS):
+            chunk = _chunk(first_set, min(CHUNK_SETS, counts['sets'] - first_set), counts, catalogues, rng)
+            chunk.to_csv(f, index=False, header=first_set == 0)
+            n_rows += len(chunk)
+    return n_rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--scale', type=float, default=1, help='size relative to the published dataset (e.g. 1, 10, 100)')
+    parser.add_argument('--out', type=Path, required=True, help='CSV file to write')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    n_rows = generate(args.out, args.scale, args.seed)
+    print(f'Wrote {n_rows:,} rows to {args.out}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,276 @@
+"""Headless benchmark of the dashboard pages.
+
+For every scale, a synthetic dataset is generated (see bench.generate) and
+its snapshot built once. Then each page runs in a subprocess of its own,
+so peak memory is per page, through a scripted sequence of widget
+interactions (SCENARIOS), repeated --repeats times in the same process:
+the first pass shows cold-cache reruns and the later ones warm reruns.
+
+Per page the results hold:
+
+- rerun latency percentiles, plus the latency of every step;
+- peak resident memory of the process;
+- payload bytes: the serialized size of the ForwardMsgs sent to the browser.
+
+The results are written as JSON for bench.compare.
+
+Streamlit 1.22 has no app-testing API, so pages are run with
+streamlit.testing's LocalScriptRunner against a mocked Runtime, which is how
+Streamlit's own tests run scripts. Widget interactions are replayed by
+editing the widget states passed to each rerun.
+
+Usage: python -m bench.run --scales 1 10 100 --repeats 3 --out bench/results/HEAD.json
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+import numpy as np
+
+from bench.generate import generate
+
+REPO = Path(__file__).resolve().parent.parent
+BENCH_DIR = REPO / 'bench'
+PAGES = ['Home.py', 'pages/01_Theme_Explorer.py', 'pages/02_Forecaster.py']
+
+# Steps of (name, {widget label or key: new value}); each step keeps the values set by the previous ones
+SCENARIOS = {
+    'Home.py': [
+        ('initial', {}),
+        ('year range', {'Select the Start and End Years': (1990, 2010)}),
+        ('top n 5', {'Consider the Top N Master Themes': 5}),
+        ('top n 15', {'Consider the Top N Master Themes': 15}),
+        ('top 10 sets', {'Show the K Largest Sets per Year': 10}),
+        ('top sets of a theme', {'Of the Master Theme': 1}),
+        ('table search', {'free_table_search': 'Set 1'}),
+        ('table sort', {'free_table_sort_column': 'num_parts', 'free_table_order': 'Desc'}),
+        ('table page 2', {'free_table_page': 2}),
+        ('full range', {'Select the Start and End Years': (1950, 2017)}),
+    ],
+    'pages/01_Theme_Explorer.py': [
+        ('initial', {}),
+        ('second theme', {'What theme do you want to explore?': 1}),
+        ('year range', {'Select the Start and End Years': (1990, 2010)}),
+        ('table sort', {'theme_table_sort_column': 'quantity'}),
+        ('first theme', {'What theme do you want to explore?': 0}),
+    ],
+    'pages/02_Forecaster.py': [
+        ('initial', {}),
+        ('differencing 1', {'Order of Differencing:': 1}),
+        ('manual order', {'Insert the value of hyperparameter p': 2, 'Insert the value of hyperparameter q': 1}),
+        ('automatic search', {'How should the ARIMA hyperparameters be chosen?': 'Automatic search'}),
+        ('batch backtests', {'batch_run': True}),
+        ('year range', {'Select the Start and End Years': (1970, 2017)}),
+    ],
+}
+
+
+def _widget_protos(messages):
+    """{widget id: (element type, proto)} of the widgets in messages."""
+    widgets = {}
+    for msg in messages:
+        if msg.WhichOneof('type') != 'delta' or msg.delta.WhichOneof('type') != 'new_element':
+            continue
+        element = msg.delta.new_element
+        kind = element.WhichOneof('type')
+        proto = getattr(element, kind)
+        if getattr(proto, 'id', ''):
+            widgets[proto.id] = (kind, proto)
+    return widgets
+
+
+def _find_widget(widgets, target):
+    for widget_id, (kind, proto) in widgets.items():
+        if widget_id.endswith(f'-{target}') or getattr(proto, 'label', None) == target:
+            return widget_id, kind, proto
+    raise KeyError(f'No widget with label or key {target!r} on the page')
+
+
+def _set_value(state, kind, proto, value):
+    """Write value into the WidgetState proto state the way the browser would for a widget of this kind."""
+    if kind == 'slider':
+        state.double_array_value.data[:] = list(value) if isinstance(value, (tuple, list)) else [value]
+    elif kind == 'number_input':
+        if proto.data_type == proto.INT:
+            state.int_value = int(value)
+        else:
+            state.double_value = float(value)
+    elif kind == 'checkbox':
+        state.bool_value = bool(value)
+    elif kind in ('radio', 'selectbox'):
+        options = list(proto.options)
+        state.int_value = options.index(value) if isinstance(value, str) else int(value)
+    elif kind == 'multiselect':
+        options = list(proto.options)
+        state.int_array_value.data[:] = [options.index(v) for v in value]
+    elif kind in ('text_input', 'text_area'):
+        state.string_value = value
+    elif kind == 'button':
+        state.trigger_value = True
+    else:
+        raise ValueError(f'Cannot set a value on a {kind} widget')
+
+
+def _mock_runtime():
+    from unittest.mock import MagicMock
+
+    from streamlit.runtime import Runtime
+    from streamlit.runtime.caching.storage.dummy_cache_storage import MemoryCacheStorageManager
+    from streamlit.runtime.media_file_manager import MediaFileManager
+    from streamlit.runtime.memory_media_file_storage import MemoryMediaFileStorage
+
+    runtime = MagicMock(spec=Runtime)
+    runtime.media_file_mgr = MediaFileManager(MemoryMediaFileStorage('/media'))
+    runtime.cache_storage_manager = MemoryCacheStorageManager()
+    Runtime._instance = runtime
+
+
+def run_page(page, repeats, timeout):
+    """Replay the scenario of page repeats times in this process and return its measurements."""
+    from streamlit import source_util
+    from streamlit.proto.WidgetStates_pb2 import WidgetStates
+    from streamlit.runtime.scriptrunner import RerunData
+    from streamlit.testing.local_script_runner import LocalScriptRunner
+
+    _mock_runtime()
+    os.chdir(REPO)
+    sys.path.insert(0, str(REPO))
+    script = str(REPO / page)
+
+    steps = []
+    for repeat in range(repeats):
+        session_state = None
+        widgets = {}
+        for name, changes in SCENARIOS[page]:
+            states = {state.id: state for state in (session_state.get_widget_states() if session_state else [])}
+            for target, value in changes.items():
+                widget_id, kind, proto = _find_widget(widgets, target)
+                state = states.setdefault(widget_id, WidgetStates().widgets.add())
+                state.id = widget_id
+                _set_value(state, kind, proto, value)
+
+            source_util._cached_pages = None
+            runner = LocalScriptRunner(script, session_state)
+            runner.request_rerun(RerunData(widget_states=WidgetStates(widgets=list(states.values()))))
+            start = time.perf_counter()
+            runner.start()
+            runner._script_thread.join(timeout)
+            latency = time.perf_counter() - start
+            if runner._script_thread.is_alive():
+                runner.request_stop()
+                raise RuntimeError(f'{page} step {name!r} did not finish within {timeout}s')
+
+            messages = runner.forward_msgs()
+            exceptions = [msg.delta.new_element.exception.message for msg in messages
+                          if msg.WhichOneof('type') == 'delta' and msg.delta.new_element.WhichOneof('type') == 'exception']
+            steps.append({'repeat': repeat, 'step': name, 'latency_ms': latency * 1000,
+                          'payload_bytes': sum(msg.ByteSize() for msg in messages),
+                          'messages': len(messages), 'exceptions': exceptions})
+            session_state = runner.session_state
+            widgets = _widget_protos(messages)
+
+    latencies = np.array([step['latency_ms'] for step in steps])
+    payloads = np.array([step['payload_bytes'] for step in steps])
+    return {
+        'reruns': len(steps),
+        'latency_ms': {'p50': float(np.percentile(latencies, 50)), 'p90': float(np.percentile(latencies, 90)),
+                       'p99': float(np.percentile(latencies, 99)), 'max': float(latencies.max()),
+                       'first': float(latencies[0])},
+        'payload_bytes': {'mean': float(payloads.mean()), 'max': int(payloads.max()), 'total': int(payloads.sum())},
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 if sys.platform != 'darwin' else 1024 ** 2),
+        'exceptions': sum(len(step['exceptions']) for step in steps),
+        'steps': steps,
+    }
+
+
+def _page_subprocess(page, env, repeats, timeout):
+    with tempfile.TemporaryDirectory() as tmp:
+        result_file = Path(tmp) / 'result.json'
+        subprocess.run([sys.executable, '-m', 'bench.run', '--page', page, '--repeats', str(repeats),
+                        '--timeout', str(timeout), '--result-file', str(result_file)],
+                       cwd=REPO, env=env, check=True)
+        return json.loads(result_file.read_text())
+
+
+def _prepare(scale, data_dir):
+    """Generate the dataset of scale if needed and build its snapshot; return the environment of its page runs."""
+    csv_path = data_dir / f'lego_{scale:g}x.csv'
+    if not csv_path.exists():
+        print(f'Generating the {scale:g}x dataset...', flush=True)
+        generate(csv_path, scale)
+    env = dict(os.environ, LEGO_DATA_URL=str(csv_path), LEGO_DATA_DIR=str(data_dir / f'{scale:g}x'))
+    subprocess.run([sys.executable, '-c', 'from lego.data import update_snapshot; update_snapshot(refresh=True)'],
+                   cwd=REPO, env=env, check=True)
+    return env, csv_path
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(scales, pages, repeats, timeout, data_dir):
+    """Benchmark pages at every scale; return the results document."""
+    import pandas as pd
+    import streamlit
+
+    results = {
+        'commit': _git_commit(),
+        'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'streamlit': streamlit.__version__,
+        'pandas': pd.__version__,
+        'repeats': repeats,
+        'scales': {},
+    }
+    for scale in scales:
+        env, csv_path = _prepare(scale, data_dir)
+        scale_results = results['scales'][f'{scale:g}x'] = {'dataset_bytes': csv_path.stat().st_size, 'pages': {}}
+        for page in pages:
+            print(f'{scale:g}x {page}...', flush=True)
+            page_results = _page_subprocess(page, env, repeats, timeout)
+            scale_results['pages'][page] = page_results
+            latency = page_results['latency_ms']
+            print(f'  p50 {latency["p50"]:.0f} ms  p90 {latency["p90"]:.0f} ms  max {latency["max"]:.0f} ms  '
+                  f'peak {page_results["peak_rss_mb"]:.0f} MB  payload {page_results["payload_bytes"]["mean"] / 1024:.0f} KiB/rerun'
+                  + (f'  {page_results["exceptions"]} exceptions' if page_results['exceptions'] else ''), flush=True)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--scales', type=float, nargs='+', default=[1, 10, 100])
+    parser.add_argument('--pages', nargs='+', default=PAGES, choices=PAGES)
+    parser.add_argument('--repeats', type=int, default=3, help='passes over each scenario')
+    parser.add_argument('--timeout', type=float, default=600, help='seconds allowed per rerun')
+    parser.add_argument('--data-dir', type=Path, default=BENCH_DIR / 'data', help='where datasets and snapshots are kept')
+    parser.add_argument('--out', type=Path, help='results file (default: bench/results/<commit>.json)')
+    parser.add_argument('--page', help=argparse.SUPPRESS)
+    parser.add_argument('--result-file', type=Path, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.page:
+        # Child process: run one page and hand the results back through a file
+        args.result_file.write_text(json.dumps(run_page(args.page, args.repeats, args.timeout)))
+        return
+
+    results = run(args.scales, args.pages, args.repeats, args.timeout, args.data_dir)
+    out = args.out or BENCH_DIR / 'results' / f'{(results["commit"] or "results")[:12]}.json'
+    out.parent.mkdir(parents=True, exist_ok=True)
+    out.write_text(json.dumps(results, indent=2))
+    print(f'Results written to {out}')
+
+
+if __name__ == '__main__':
+    main()
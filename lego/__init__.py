@@ -0,0 +1 @@
+"""Shared helpers for the Lego Sets Explorer dashboard pages."""
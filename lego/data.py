@@ -0,0 +1,183 @@
+"""Loading of the combined, part-level Lego dataset.
+
+The CSV published on S3 is downloaded once, converted to compact dtypes and
+stored as a local Arrow (Feather) snapshot. Later loads memory-map the
+snapshot, and the snapshot also stands in for the source whenever the source
+cannot be reached.
+
+Newer catalogue data is added as delta files (see ingest_delta): part rows of
+new or changed sets, stored next to the snapshot and applied on top of it in
+the order they were ingested. A set in a delta replaces every earlier row with
+the same set_num. Deltas are kept when the snapshot is refreshed, so they are
+applied again on top of the new source.
+
+Only a missing snapshot is downloaded while a page waits. A stale one is
+refreshed on a background thread, and pages keep using it until the new
+snapshot is in place.
+
+All sessions and pages share a single read-only copy of the dataset through
+lego.schema.get_schema(), whose part rows are the memory-mapped snapshot;
+callers must never modify its frames in place.
+"""
+import os
+import tempfile
+import threading
+import time
+import warnings
+from pathlib import Path
+
+import pandas as pd
+import pyarrow.feather as feather
+
+DATA_URL = os.environ.get(
+    'LEGO_DATA_URL',
+    'https://miles-become-a-data-scientist.s3.us-east-2.amazonaws.com/J3/M2/df_combined_lego.csv')
+DATA_DIR = Path(os.environ.get('LEGO_DATA_DIR', Path(__file__).resolve().parent.parent / 'data'))
+SNAPSHOT_PATH = DATA_DIR / 'df_combined_lego.arrow'
+DELTA_DIR = DATA_DIR / 'deltas'
+
+# Age (in seconds) after which the snapshot is refreshed from DATA_URL
+SNAPSHOT_MAX_AGE = int(os.environ.get('LEGO_SNAPSHOT_MAX_AGE', 24 * 60 * 60))
+
+# Time before which a failed download is not attempted again
+_retry_after = 0.0
+# Held while the snapshot is downloaded, so concurrent sessions download it once
+_update_lock = threading.Lock()
+_refresh_thread = None
+_refresh_thread_lock = threading.Lock()
+
+# Repeated names are stored once per distinct value instead of once per part row
+CATEGORY_COLUMNS = ['parent_theme_name', 'theme_name', 'set_num', 'set_name',
+                    'part_num', 'part_name', 'part_category_name', 'color_name']
+INTEGER_COLUMNS = ['year', 'quantity', 'num_parts']
+# Snapshot rows are ordered by set, in the order of lego.schema's set ids, so the
+# schema can use the memory-mapped part rows as they are
+SET_ORDER = ['year', 'set_num', 'set_name', 'num_parts', 'parent_theme_name', 'theme_name']
+
+
+def compact_dtypes(df):
+    """Return df with categorical names, small integers and a boolean is_trans."""
+    df = df.copy()
+    for col in CATEGORY_COLUMNS:
+        if col in df.columns:
+            df[col] = df[col].astype('category')
+    for col in INTEGER_COLUMNS:
+        if col in df.columns and not df[col].isna().any():
+            df[col] = pd.to_numeric(df[col], downcast='integer')
+    if 'is_trans' in df.columns and df['is_trans'].dtype != bool:
+        df['is_trans'] = df['is_trans'].map({'t': True, 'f': False, 'True': True, 'False': False,
+                                             True: True, False: False}).fillna(False).astype(bool)
+    return df
+
+
+def fetch_dataset(url=DATA_URL):
+    """Download and parse the source CSV."""
+    return compact_dtypes(pd.read_csv(url))
+
+
+def write_snapshot(df, path=SNAPSHOT_PATH):
+    """Store df, ordered by SET_ORDER, as an uncompressed Arrow file, replacing any previous snapshot atomically."""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    order = [col for col in SET_ORDER if col in df.columns]
+    # A temporary file of its own per writer, so a rename never publishes a file still being written
+    fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=path.parent)
+    os.close(fd)
+    try:
+        df.sort_values(order, kind='stable').reset_index(drop=True).to_feather(tmp_path, compression='uncompressed')
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def read_snapshot(path=SNAPSHOT_PATH):
+    """Memory-map the snapshot; numeric columns are used without copying them into the heap."""
+    table = feather.read_table(str(path), memory_map=True)
+    return table.to_pandas(split_blocks=True, self_destruct=True)
+
+
+def snapshot_is_stale(path=SNAPSHOT_PATH, max_age=SNAPSHOT_MAX_AGE):
+    path = Path(path)
+    return not path.exists() or time.time() - path.stat().st_mtime > max_age
+
+
+def update_snapshot(refresh=False):
+    """Download the source into the snapshot when the snapshot is missing or stale.
+
+    If the download fails, an existing snapshot is kept regardless of its age
+    and the download is not retried for another SNAPSHOT_MAX_AGE seconds.
+    """
+    global _retry_after
+    if not refresh and (not snapshot_is_stale() or time.time() < _retry_after):
+        return
+    with _update_lock:
+        # Another thread may have refreshed the snapshot while this one waited
+        if not refresh and (not snapshot_is_stale() or time.time() < _retry_after):
+            return
+        try:
+            df = fetch_dataset()
+        except OSError as exc:
+            if not SNAPSHOT_PATH.exists():
+                raise
+            _retry_after = time.time() + SNAPSHOT_MAX_AGE
+            warnings.warn(f'Could not reach {DATA_URL} ({exc}); using the local snapshot instead.')
+            return
+        write_snapshot(df)
+
+
+def refresh_in_background():
+    """Run update_snapshot on a daemon thread, unless a refresh is already running."""
+    global _refresh_thread
+    with _refresh_thread_lock:
+        if _refresh_thread is None or not _refresh_thread.is_alive():
+            _refresh_thread = threading.Thread(target=update_snapshot, name='lego-snapshot-refresh', daemon=True)
+            _refresh_thread.start()
+
+
+def dataset_version():
+    """Identifier of the current snapshot, used to key structures derived from it.
+
+    A missing snapshot is downloaded first; a stale one is refreshed in the
+    background and identifies the dataset until the refresh completes.
+    """
+    if not SNAPSHOT_PATH.exists():
+        update_snapshot()
+    elif snapshot_is_stale() and time.time() >= _retry_after:
+        refresh_in_background()
+    stat = SNAPSHOT_PATH.stat()
+    return f'{stat.st_mtime_ns}-{stat.st_size}'
+
+
+def delta_names(delta_dir=DELTA_DIR):
+    """File names of the ingested deltas, in the order they must be applied."""
+    if not delta_dir.exists():
+        return ()
+    return tuple(sorted(name for name in os.listdir(delta_dir) if name.endswith('.arrow')))
+
+
+def read_delta(name, delta_dir=DELTA_DIR):
+    return read_snapshot(delta_dir / name)
+
+
+def ingest_delta(source, delta_dir=DELTA_DIR):
+    """Store the CSV at source (a path or URL) as the next delta and return its path.
+
+    The delta must have the columns of the source dataset and hold every part
+    row of each set it contains.
+    """
+    df = compact_dtypes(pd.read_csv(source))
+    missing = set(CATEGORY_COLUMNS + INTEGER_COLUMNS) - set(df.columns)
+    if missing:
+        raise ValueError(f'{source} is missing the columns {sorted(missing)}')
+    names = delta_names(delta_dir)
+    sequence = int(names[-1].split('-', 1)[0]) + 1 if names else 1
+    path = delta_dir / f'{sequence:06d}-{Path(str(source)).stem}.arrow'
+    write_snapshot(df, path)
+    return path
+
+
+def load_dataset(refresh=False):
+    """Return the dataset, downloading it only when the snapshot is missing or stale."""
+    update_snapshot(refresh)
+    return read_snapshot()
@@ -0,0 +1,181 @@
+"""Plotly figures of the dashboard pages.
+
+Each figure is cached on the inputs it actually depends on plus the dataset
+version, so a widget change only rebuilds the figures that use that widget.
+Cached figures are shared by every session and must not be modified.
+
+Parent themes get one colour each per dataset version (parent_theme_colors),
+so a theme keeps its colour across charts, year ranges and Top N choices.
+Traces with many points are drawn with WebGL (see scatter).
+"""
+import os
+
+import numpy as np
+import plotly.express as px
+import plotly.graph_objects as go
+import streamlit as st
+
+from lego import instrumentation, queries
+from lego.forecasting import series_hash
+from lego.schema import get_schema
+
+# Maximum number of cached figures per builder
+FIGURE_CACHE_SIZE = int(os.environ.get('LEGO_FIGURE_CACHE_SIZE', 64))
+# Number of points above which scatter traces are drawn with WebGL
+WEBGL_THRESHOLD = int(os.environ.get('LEGO_WEBGL_THRESHOLD', 1000))
+
+COLORS_SCALED = ["#1F78C8","#ff0000","#33a02c","#6A33C2","#ff7f00","#565656",
+    "#FFD700","#a6cee3","#FB6496","#b2df8a","#CAB2D6","#FDBF6F",
+    "#999999","#EEE685","#C8308C","#FF83FA","#C814FA","#0000FF",
+    "#36648B","#00E2E5","#00FF00","#778B00","#BEBE00","#8B3B00",
+    "#A52A3C"]
+REMAINDER_COLOR = '#808080'
+# Colours given to the parent themes, largest first; the palette repeats if there are more themes
+THEME_PALETTE = COLORS_SCALED + px.colors.qualitative.Alphabet + px.colors.qualitative.Light24
+
+
+def _cached(func):
+    return st.cache_resource(max_entries=FIGURE_CACHE_SIZE, show_spinner=False)(instrumentation.timed('figure')(func))
+
+
+def scatter(x, y, **kwargs):
+    """go.Scatter of x and y, or go.Scattergl when there are more than WEBGL_THRESHOLD points."""
+    trace = go.Scattergl if len(x) > WEBGL_THRESHOLD else go.Scatter
+    return trace(x=x, y=y, **kwargs)
+
+
+@st.cache_resource(show_spinner=False, max_entries=2)
+@instrumentation.timed('figure')
+def _parent_theme_colors(version):
+    sets = get_schema().sets
+    ranked = queries.parent_themes_ranked((int(sets.year.min()), int(sets.year.max())))
+    names = ranked.parent_theme_name.astype(str).tolist()
+    colors = {name: THEME_PALETTE[i % len(THEME_PALETTE)] for i, name in enumerate(names)}
+    colors['Remainder'] = REMAINDER_COLOR
+    return colors
+
+
+def parent_theme_colors():
+    """{parent theme: colour} of every parent theme, ranked by number of sets over all years, plus 'Remainder'."""
+    return _parent_theme_colors(get_schema().version)
+
+
+@_cached
+def _sets_per_parent_theme_bar(version, year_range, top_n):
+    sets_per_parent_theme = queries.sets_per_parent_theme(year_range, top_n)
+
+    fig_parent_theme = px.bar(sets_per_parent_theme, x='nbr_sets', y='parent_theme_name',
+        color='parent_theme_name', color_discrete_map=parent_theme_colors(),
+        labels={'nbr_sets': 'Number of Sets', 'parent_theme_name': 'Parent Theme'},
+        title=f'Number of Sets per Parent Theme (Top {top_n})')
+    fig_parent_theme.update_yaxes(title_text='', automargin=True)
+    return fig_parent_theme
+
+
+def sets_per_parent_theme_bar(year_range, top_n):
+    return _sets_per_parent_theme_bar(get_schema().version, tuple(year_range), top_n)
+
+
+@_cached
+def _new_sets_per_year_bar(version, year_range, top_n):
+    sets_per_year_master_theme = queries.new_sets_per_year(year_range, top_n)
+
+    fig_sets_per_master = px.bar(sets_per_year_master_theme,
+                x="year",
+                y="set_name",
+                color='parent_theme_name',
+                title=f'Number of New Sets per Year for the Top {top_n} Parent Themes',
+                color_discrete_map=parent_theme_colors())
+    fig_sets_per_master.update_layout(xaxis_title='Year',
+                    yaxis_title='Number of New Sets')
+    return fig_sets_per_master
+
+
+def new_sets_per_year_bar(year_range, top_n):
+    return _new_sets_per_year_bar(get_schema().version, tuple(year_range), top_n)
+
+
+@_cached
+def _top_sets_per_year_plot(version, year_range, k, parent_theme):
+    top_sets_year = queries.top_sets_per_year(year_range, k, parent_theme)
+    of_theme = f' of {parent_theme}' if parent_theme else ''
+
+    if k == 1:
+        fig_top_sets_year = px.bar(top_sets_year,
+                    x="year",
+                    y="num_parts",
+                    color='parent_theme_name',
+                    hover_data=['theme_set'],
+                    title=f'Largest Set (# of Parts) per Year{of_theme}',
+                    color_discrete_map=parent_theme_colors())
+    else:
+        # Stacked bars would add up the sets of a year, so each set is a marker instead
+        fig_top_sets_year = px.scatter(top_sets_year,
+                    x="year",
+                    y="num_parts",
+                    color='parent_theme_name',
+                    hover_data=['theme_set', 'rank'],
+                    title=f'Top {k} Largest Sets (# of Parts) per Year{of_theme}',
+                    color_discrete_map=parent_theme_colors())
+    fig_top_sets_year.update_layout(xaxis_title='Year',
+                    yaxis_title='Number of Parts')
+    return fig_top_sets_year
+
+
+def top_sets_per_year_plot(year_range, k=1, parent_theme=None):
+    """Bar chart of the largest set of every year, or markers of the k largest ones."""
+    return _top_sets_per_year_plot(get_schema().version, tuple(year_range), k, parent_theme)
+
+
+@_cached
+def _theme_sunburst(version, year_range, theme):
+    df_sunburst = queries.theme_tree(year_range, theme)
+    return px.sunburst(df_sunburst, path=['parent_theme_name', 'theme_name', 'set_name'], values='nbr', height=800, color_discrete_sequence=px.colors.qualitative.Plotly)
+
+
+def theme_sunburst(year_range, theme):
+    return _theme_sunburst(get_schema().version, tuple(year_range), theme)
+
+
+@st.cache_data(show_spinner=False, max_entries=FIGURE_CACHE_SIZE)
+@instrumentation.timed('model')
+def _correlations(series_key, order_differencing, _series):
+    from statsmodels.tsa.stattools import acf, pacf
+
+    series = _series.diff(order_differencing) if order_differencing else _series
+    return {'acf': acf(series.dropna(), alpha=0.05), 'pacf': pacf(series.dropna(), alpha=0.05)}
+
+
+def correlations(series, order_differencing):
+    """ACF and PACF (values and 95% confidence intervals) of series differenced at lag order_differencing.
+
+    Cached per (series hash, order of differencing), as {'acf': ..., 'pacf': ...}.
+    """
+    return _correlations(series_hash(series), order_differencing, series)
+
+
+def corr_plot(series, order_differencing, plot_pacf=False):
+    """Stem plot of the ACF (or PACF) of series differenced at lag order_differencing, with its confidence band."""
+    corr_array = correlations(series, order_differencing)['pacf' if plot_pacf else 'acf']
+    lags = np.arange(len(corr_array[0]))
+    lower_y = corr_array[1][:,0] - corr_array[0]
+    upper_y = corr_array[1][:,1] - corr_array[0]
+
+    # All stems in one trace: a (lag, 0) -> (lag, value) segment per lag, separated by gaps
+    stems_x = np.repeat(lags, 3).astype(float)
+    stems_y = np.column_stack([np.zeros(len(lags)), corr_array[0], np.full(len(lags), np.nan)]).ravel()
+    stems_x[2::3] = np.nan
+
+    fig = go.Figure()
+    fig.add_trace(scatter(stems_x, stems_y, mode='lines', line_color='#3f3f3f'))
+    fig.add_trace(scatter(lags, corr_array[0], mode='markers', marker_color='#1f77b4', marker_size=12))
+    fig.add_trace(scatter(lags, upper_y, mode='lines', line_color='rgba(255,255,255,0)'))
+    fig.add_trace(scatter(lags, lower_y, mode='lines', fillcolor='rgba(32, 146, 230,0.3)',
+            fill='tonexty', line_color='rgba(255,255,255,0)'))
+    fig.update_traces(showlegend=False)
+    fig.update_xaxes(range=[-1,15])
+    fig.update_yaxes(zerolinecolor='#000000')
+
+    title='Partial Autocorrelation (PACF)' if plot_pacf else 'Autocorrelation (ACF)'
+    fig.update_layout(title=title)
+    return fig
@@ -0,0 +1,311 @@
+"""ARIMA fitting for the Forecaster page.
+
+Fitted models are kept in a process-wide LRU cache keyed by a hash of the
+training series and the (p, d, q) order, so reruns and repeated selections do
+not refit. The automatic order search fits the candidate grid in a pool of
+worker processes and ranks the candidates by AIC, BIC and test-set RMSE.
+
+The batch mode backtests one order on the yearly series of every parent theme
+at once: each series is scored over several rolling forecast origins in the
+same process pool, and the results table is cached per dataset version.
+"""
+import hashlib
+import multiprocessing
+import os
+import threading
+import warnings
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itertools import product, repeat
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+from lego import instrumentation, queries
+from lego.schema import get_schema
+
+# Maximum number of fitted models kept in memory
+MODEL_CACHE_SIZE = int(os.environ.get('LEGO_MODEL_CACHE_SIZE', 256))
+# Number of worker processes used to fit candidate models
+FORECAST_WORKERS = int(os.environ.get('LEGO_FORECAST_WORKERS', os.cpu_count() or 1))
+
+# Years held out as the test set of the Forecaster
+TEST_YEARS = 5
+# Fewest years a backtest fold may be trained on
+MIN_TRAIN_YEARS = int(os.environ.get('LEGO_MIN_TRAIN_YEARS', 10))
+
+RANKING_CRITERIA = ['aic', 'bic', 'rmse']
+BACKTEST_METRICS = ['rmse', 'mae', 'smape']
+
+
+def yearly_sets(year_range, test_years=TEST_YEARS):
+    """Yearly number of new sets in year_range, indexed by year-end date, and its (train, test) split.
+
+    The test set holds the last test_years years.
+    """
+    df_nbr_sets_year = queries.new_sets_per_year_total(year_range)
+    df_nbr_sets_year['date'] = '31-12-' + df_nbr_sets_year.year.astype(int).astype(str)
+    df_nbr_sets_year['date'] = pd.to_datetime(df_nbr_sets_year['date'], dayfirst=True)
+    df_nbr_sets_year = df_nbr_sets_year.set_index('date').asfreq(freq='Y')
+    df_nbr_sets_year['nbr_sets'] = df_nbr_sets_year.nbr_sets.fillna(0)
+    return df_nbr_sets_year, df_nbr_sets_year.iloc[:-test_years].copy(), df_nbr_sets_year.iloc[-test_years:]
+
+
+def series_hash(series):
+    """Hash of the values and index of series, used to key cached models."""
+    return hashlib.sha1(pd.util.hash_pandas_object(series, index=True).to_numpy().tobytes()).hexdigest()
+
+
+class ModelCache:
+    """Thread-safe LRU mapping of hashable keys (e.g. (series hash, order)) to fitted models or their scores."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._models = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            model = self._models.get(key)
+            if model is not None:
+                self._models.move_to_end(key)
+            return model
+
+    def put(self, key, model):
+        with self._lock:
+            self._models[key] = model
+            self._models.move_to_end(key)
+            while len(self._models) > self.max_entries:
+                self._models.popitem(last=False)
+
+
+@st.cache_resource(show_spinner=False)
+def get_model_cache():
+    return ModelCache(MODEL_CACHE_SIZE)
+
+
+@st.cache_resource(show_spinner=False)
+def _score_cache():
+    return ModelCache(MODEL_CACHE_SIZE)
+
+
+@st.cache_resource(show_spinner=False)
+def _process_pool():
+    # Forking the threaded Streamlit server could copy a lock held by another thread into a worker; spawn starts clean ones
+    return ProcessPoolExecutor(max_workers=FORECAST_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+
+
+def _parallel_map(func, *iterables):
+    """list(map(func, *iterables)) evaluated in the process pool."""
+    iterables = [list(iterable) for iterable in iterables]
+    chunksize = max(1, len(iterables[0]) // (FORECAST_WORKERS * 4))
+    try:
+        return list(_process_pool().map(func, *iterables, chunksize=chunksize))
+    except BrokenProcessPool:
+        # A worker died; start a new pool next time and run this batch here
+        _process_pool.clear()
+        return list(map(func, *iterables))
+
+
+@instrumentation.timed('model')
+def _fit(train, order):
+    from statsmodels.tsa.arima.model import ARIMA
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        return ARIMA(train, order=order).fit()
+
+
+def fit_arima(train, order):
+    """ARIMA of the given order fitted on train, taken from the model cache when available."""
+    key = (series_hash(train), tuple(int(value) for value in order))
+    cache = get_model_cache()
+    model = cache.get(key)
+    if model is None:
+        model = _fit(train, key[1])
+        cache.put(key, model)
+    return model
+
+
+def rmse(actual, predicted):
+    return float(np.sqrt(np.mean((np.asarray(actual, dtype=float) - np.asarray(predicted, dtype=float)) ** 2)))
+
+
+@st.cache_data(show_spinner=False, max_entries=MODEL_CACHE_SIZE)
+@instrumentation.timed('model')
+def _adf_test(series_key, _series):
+    from statsmodels.tsa.stattools import adfuller
+
+    return adfuller(_series.dropna())
+
+
+def adf_test(series):
+    """Augmented Dickey-Fuller test of series, as returned by statsmodels' adfuller (statistic, p-value, ...)."""
+    return _adf_test(series_hash(series), series)
+
+
+def _scores(model, test):
+    return {'aic': model.aic, 'bic': model.bic, 'rmse': rmse(test, model.forecast(len(test)))}
+
+
+def _fit_candidate(train, test, order):
+    """Fit and score one candidate; runs in a worker process.
+
+    Any failure is returned as the candidate's error, so one bad order cannot
+    abort the whole search.
+    """
+    try:
+        model = _fit(train, order)
+        return order, model, _scores(model, test)
+    except Exception as exc:
+        return order, None, {'error': f'{type(exc).__name__}: {exc}'}
+
+
+def order_search(train, test, max_p, max_d, max_q):
+    """Fit every (p, d, q) up to the given maxima and return one row of scores per order.
+
+    Orders already in the model cache are scored from there; the others are
+    fitted in parallel and added to the cache.
+    """
+    cache = get_model_cache()
+    score_cache = _score_cache()
+    train_hash = series_hash(train)
+    test_hash = series_hash(test)
+    orders = list(product(range(max_p + 1), range(max_d + 1), range(max_q + 1)))
+
+    rows = []
+    pending = []
+    for order in orders:
+        scores = score_cache.get((train_hash, test_hash, order))
+        model = cache.get((train_hash, order)) if scores is None else None
+        if scores is None and model is not None:
+            scores = _scores(model, test)
+            score_cache.put((train_hash, test_hash, order), scores)
+        if scores is None:
+            pending.append(order)
+        else:
+            rows.append({'p': order[0], 'd': order[1], 'q': order[2], **scores})
+
+    if pending:
+        results = _parallel_map(_fit_candidate, repeat(train, len(pending)), repeat(test, len(pending)), pending)
+        for order, model, scores in results:
+            if model is not None:
+                cache.put((train_hash, order), model)
+                score_cache.put((train_hash, test_hash, order), scores)
+            rows.append({'p': order[0], 'd': order[1], 'q': order[2], **scores})
+
+    leaderboard = pd.DataFrame(rows).reindex(columns=['p', 'd', 'q'] + RANKING_CRITERIA + ['error'])
+    for criterion in RANKING_CRITERIA:
+        leaderboard[f'{criterion}_rank'] = leaderboard[criterion].rank(method='min')
+    return leaderboard
+
+
+@st.cache_data(show_spinner=False, max_entries=64)
+@instrumentation.timed('model')
+def _leaderboard(train_hash, test_hash, max_p, max_d, max_q, _train, _test):
+    return order_search(_train, _test, max_p, max_d, max_q)
+
+
+def leaderboard(train, test, max_p, max_d, max_q):
+    """order_search, cached per (train, test, grid) across sessions."""
+    return _leaderboard(series_hash(train), series_hash(test), max_p, max_d, max_q, train, test)
+
+
+def yearly_series(counts):
+    """counts indexed by year as a float series on a year-end DatetimeIndex, the way the Forecaster models it."""
+    index = pd.DatetimeIndex(pd.to_datetime(counts.index.astype(int).astype(str) + '-12-31'), freq='A-DEC')
+    return pd.Series(counts.to_numpy(dtype=float), index=index, name=counts.name)
+
+
+def rolling_origins(n_obs, horizon, n_origins, min_train=MIN_TRAIN_YEARS):
+    """Training lengths of the rolling-origin folds, oldest first.
+
+    The last fold ends horizon observations before the end of the series and
+    each earlier origin moves back by one observation; folds shorter than
+    min_train are dropped.
+    """
+    last = n_obs - horizon
+    return [length for length in range(last - n_origins + 1, last + 1) if length >= min_train]
+
+
+def error_metrics(actual, predicted):
+    """RMSE, MAE and symmetric MAPE (in %) of predicted against actual."""
+    actual = np.asarray(actual, dtype=float)
+    predicted = np.asarray(predicted, dtype=float)
+    denominator = np.abs(actual) + np.abs(predicted)
+    ratios = np.divide(2 * np.abs(actual - predicted), denominator, out=np.zeros_like(actual), where=denominator > 0)
+    return {'rmse': rmse(actual, predicted), 'mae': float(np.mean(np.abs(actual - predicted))),
+            'smape': float(100 * np.mean(ratios))}
+
+
+def backtest(series, order, horizon, n_origins):
+    """Rolling-origin backtest of one yearly series, then a forecast of its next horizon years.
+
+    Years before the first non-zero value are dropped, since a theme does not
+    exist before its first release. Returns a dict of metrics pooled over the
+    folds and a frame of forecasts with columns date, origin, kind ('backtest'
+    or 'forecast') and forecast.
+    """
+    released = np.flatnonzero(series.to_numpy())
+    series = series.iloc[released[0]:] if len(released) else series.iloc[:0]
+    metrics = {'n_years': len(series), 'n_folds': 0}
+    lengths = rolling_origins(len(series), horizon, n_origins)
+    if not lengths:
+        return {**metrics, 'error': f'Fewer than {MIN_TRAIN_YEARS + horizon} years since the first release'}, None
+
+    actual, predicted, forecasts = [], [], []
+    try:
+        for length in lengths + [len(series)]:
+            preds = _fit(series.iloc[:length], order).forecast(horizon)
+            kind = 'backtest' if length < len(series) else 'forecast'
+            forecasts.append(pd.DataFrame({'date': preds.index, 'origin': series.index[length - 1],
+                                           'kind': kind, 'forecast': preds.to_numpy()}))
+            if kind == 'backtest':
+                actual.append(series.iloc[length:length + horizon].to_numpy())
+                predicted.append(preds.to_numpy())
+    except Exception as exc:
+        # Recorded as this series' error, so one bad series cannot abort the batch
+        return {**metrics, 'error': f'{type(exc).__name__}: {exc}'}, None
+    metrics.update(n_folds=len(lengths), **error_metrics(np.concatenate(actual), np.concatenate(predicted)))
+    return metrics, pd.concat(forecasts, ignore_index=True)
+
+
+def _backtest_task(name, series, order, horizon, n_origins):
+    """backtest of one named series; runs in a worker process."""
+    return name, *backtest(series, order, horizon, n_origins)
+
+
+def batch_backtest(panel, order, horizon, n_origins):
+    """backtest every column of panel (yearly counts indexed by year) in parallel.
+
+    Returns a metrics frame with one row per column and a long frame of all
+    the forecasts, both keyed by the column name in 'series'.
+    """
+    names = list(panel.columns)
+    results = _parallel_map(_backtest_task, names, [yearly_series(panel[name]) for name in names],
+                            repeat(tuple(order), len(names)), repeat(horizon, len(names)), repeat(n_origins, len(names)))
+    metrics = pd.DataFrame([{'series': name, **scores} for name, scores, _ in results])
+    metrics = metrics.reindex(columns=['series', 'n_years', 'n_folds'] + BACKTEST_METRICS + ['error'])
+    forecasts = [frame.assign(series=name) for name, _, frame in results if frame is not None]
+    forecasts = pd.concat(forecasts, ignore_index=True) if forecasts else pd.DataFrame(columns=['date', 'origin', 'kind', 'forecast', 'series'])
+    return metrics, forecasts
+
+
+@st.cache_data(show_spinner=False, max_entries=64)
+@instrumentation.timed('model')
+def _theme_backtests(version, year_range, order, horizon, n_origins):
+    panel = queries.new_sets_per_year_by_parent_theme(year_range)
+    metrics, forecasts = batch_backtest(panel, order, horizon, n_origins)
+    return (metrics.rename(columns={'series': 'parent_theme_name'}),
+            forecasts.rename(columns={'series': 'parent_theme_name'}))
+
+
+def theme_backtests(year_range, order, horizon, n_origins):
+    """batch_backtest of the yearly new sets of every parent theme, cached across sessions.
+
+    Returns (metrics, forecasts) keyed by parent_theme_name.
+    """
+    order = tuple(int(value) for value in order)
+    return _theme_backtests(get_schema().version, tuple(year_range), order, int(horizon), int(n_origins))
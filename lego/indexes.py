@@ -0,0 +1,431 @@
+"""Indexes built once per dataset version to answer year-range queries cheaply.
+
+Each index is built from the set table by LegoSchema.index and, when a delta
+is applied, updated with the removed and added sets only (see update()).
+The building blocks below keep just enough state for that: how many times
+each key occurs, so a key is only dropped when its last set goes away.
+
+update() changes the index in place, so it is always applied to a copy()
+(see LegoSchema.with_delta): the index of the previous dataset version stays
+as it was for the sessions still reading it. copy() only duplicates the
+containers update() modifies, not the frames and arrays it replaces.
+"""
+import copy
+import os
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+
+from lego.schema import get_schema
+
+# Number of largest sets kept per year, overall and per parent theme
+TOP_SETS = int(os.environ.get('LEGO_TOP_SETS', 25))
+
+
+def _keys(sets, columns, dropna=True):
+    """Rows of the given columns of sets as tuples of str and int values.
+
+    Rows with a missing value are skipped when dropna is set, as groupby does;
+    otherwise missing values become 'nan', as astype(str) does.
+    """
+    frame = sets[columns].dropna() if dropna else sets[columns]
+    values = [frame[col].astype('int64').tolist() if pd.api.types.is_numeric_dtype(frame[col]) else frame[col].astype(str).tolist()
+              for col in columns]
+    return list(zip(*values))
+
+
+class Occurrences:
+    """Number of occurrences of every key, reporting the keys that appear or disappear."""
+
+    def __init__(self):
+        self._counts = Counter()
+
+    def copy(self):
+        other = copy.copy(self)
+        other._counts = Counter(self._counts)
+        return other
+
+    def update(self, removed, added):
+        """Remove and add one occurrence per item; return (keys gone, keys new)."""
+        touched = set(removed) | set(added)
+        before = {key for key in touched if key in self._counts}
+        self._counts.subtract(removed)
+        self._counts.update(added)
+        for key in touched:
+            if self._counts[key] <= 0:
+                del self._counts[key]
+        after = {key for key in touched if key in self._counts}
+        return sorted(before - after), sorted(after - before)
+
+
+class FirstYears:
+    """First year of every key, from the years of all its (key..., year) rows."""
+
+    def __init__(self):
+        self._years = {}
+
+    def copy(self):
+        other = copy.copy(self)
+        other._years = dict(self._years)
+        return other
+
+    def _first(self, key):
+        years = self._years.get(key)
+        return min(years) if years else None
+
+    def update(self, removed, added):
+        """Remove and add (key..., year) rows; return (key, old first year, new first year) of the changed keys.
+
+        A key absent before or after the update has None as its first year.
+        """
+        touched = {row[:-1] for row in removed} | {row[:-1] for row in added}
+        before = {key: self._first(key) for key in touched}
+        # The year counters of the touched keys may be shared with a copy, so they are replaced rather than changed
+        for key in touched:
+            self._years[key] = Counter(self._years.get(key, ()))
+        for sign, rows in ((-1, removed), (1, added)):
+            for row in rows:
+                self._years[row[:-1]][row[-1]] += sign
+        changes = []
+        for key in touched:
+            years = self._years[key]
+            for year in [year for year, n in years.items() if n <= 0]:
+                del years[year]
+            if not years:
+                del self._years[key]
+            after = self._first(key)
+            if after != before[key]:
+                changes.append((key, before[key], after))
+        return changes
+
+
+class YearCounts:
+    """Counts per (name, year), stored as a names x years array that grows with new names and years.
+
+    Cumulative sums along the years are recomputed on every add, so the sum
+    over any year range is the difference of two of them.
+    """
+
+    def __init__(self):
+        self.rows = {}
+        self.first_year = 0
+        self.counts = np.zeros((0, 0), np.int64)
+        self.cumulative = np.zeros((0, 1), np.int64)
+
+    def copy(self):
+        other = copy.copy(self)
+        other.rows = dict(self.rows)
+        return other
+
+    def add(self, names, years, weights):
+        if not len(names):
+            return
+        years = np.asarray(years, np.int64)
+        n_years = self.counts.shape[1]
+        first_year = int(years.min()) if not n_years else min(self.first_year, int(years.min()))
+        last_year = int(years.max()) if not n_years else max(self.first_year + n_years - 1, int(years.max()))
+        for name in names:
+            self.rows.setdefault(name, len(self.rows))
+        # Build a new array, as the current one may be shared with a copy()
+        counts = np.zeros((len(self.rows), last_year - first_year + 1), np.int64)
+        offset = self.first_year - first_year
+        counts[:self.counts.shape[0], offset:offset + n_years] = self.counts
+        np.add.at(counts, ([self.rows[name] for name in names], years - first_year), weights)
+        cumulative = np.zeros((counts.shape[0], counts.shape[1] + 1), np.int64)
+        np.cumsum(counts, axis=1, out=cumulative[:, 1:])
+        self.counts, self.cumulative, self.first_year = counts, cumulative, first_year
+
+    def _columns(self, min_year, max_year):
+        lo = int(np.clip(min_year - self.first_year, 0, self.counts.shape[1]))
+        hi = int(np.clip(max_year - self.first_year + 1, 0, self.counts.shape[1]))
+        return lo, max(lo, hi)
+
+    def between(self, name, min_year, max_year):
+        """Sum of the counts of name between min_year and max_year (both inclusive)."""
+        if name not in self.rows:
+            return 0
+        lo, hi = self._columns(min_year, max_year)
+        cumulative = self.cumulative[self.rows[name]]
+        return int(cumulative[hi] - cumulative[lo])
+
+    def frame(self, min_year, max_year):
+        """Counts between min_year and max_year as a frame of years (rows) by names (columns)."""
+        lo, hi = self._columns(min_year, max_year)
+        counts, first_year = self.counts, self.first_year
+        years = pd.RangeIndex(first_year + lo, first_year + hi, name='year')
+        return pd.DataFrame(counts[:len(self.rows), lo:hi].T, index=years, columns=list(self.rows)[:counts.shape[0]])
+
+
+class FirstAppearanceIndex:
+    """Counts of entities by the year they first appear in the dataset.
+
+    Counts are kept per year along with their cumulative sums, so the count
+    for any year range takes two lookups. It is built from the set-level
+    table, since first appearances do not depend on part rows.
+    """
+
+    ENTITIES = {
+        'master_themes': ['parent_theme_name'],
+        'themes': ['theme_name'],
+        'sets': ['set_name'],
+        # Parts are counted once per distinct (set name, number of parts)
+        'parts_of_sets': ['set_name', 'num_parts'],
+    }
+
+    def __init__(self, sets):
+        self._first_years = {entity: FirstYears() for entity in self.ENTITIES}
+        self.counts_by_year = YearCounts()
+        self.update(sets.iloc[:0], sets)
+
+    def copy(self):
+        other = copy.copy(self)
+        other._first_years = {entity: first_years.copy() for entity, first_years in self._first_years.items()}
+        other.counts_by_year = self.counts_by_year.copy()
+        return other
+
+    def update(self, removed, added):
+        names, years, weights = [], [], []
+        for entity, columns in self.ENTITIES.items():
+            changes = self._first_years[entity].update(_keys(removed, columns + ['year']), _keys(added, columns + ['year']))
+            for key, old_year, new_year in changes:
+                weight = key[-1] if entity == 'parts_of_sets' else 1
+                for year, sign in ((old_year, -1), (new_year, 1)):
+                    if year is not None:
+                        names.append(entity)
+                        years.append(year)
+                        weights.append(sign * weight)
+        self.counts_by_year.add(names, years, weights)
+        return self
+
+    def counts(self, min_year, max_year):
+        """Entities first appearing between min_year and max_year (both inclusive)."""
+        return {entity: self.counts_by_year.between(entity, min_year, max_year) for entity in self.ENTITIES}
+
+
+def get_first_appearance_index():
+    return get_schema().index(FirstAppearanceIndex)
+
+
+class ThemeYearIndex:
+    """Distinct sets (by set_num) released per year, per parent theme and over all themes."""
+
+    def __init__(self, sets):
+        self._theme_sets = Occurrences()
+        self._sets = Occurrences()
+        self.per_theme_counts = YearCounts()
+        self.total_counts = YearCounts()
+        self.update(sets.iloc[:0], sets)
+
+    def copy(self):
+        other = copy.copy(self)
+        for name in ('_theme_sets', '_sets', 'per_theme_counts', 'total_counts'):
+            setattr(other, name, getattr(self, name).copy())
+        return other
+
+    def update(self, removed, added):
+        columns = ['parent_theme_name', 'year', 'set_num']
+        gone, new = self._theme_sets.update(_keys(removed, columns), _keys(added, columns))
+        self.per_theme_counts.add([key[0] for key in gone + new], [key[1] for key in gone + new],
+                                  [-1] * len(gone) + [1] * len(new))
+        gone, new = self._sets.update(_keys(removed, columns[1:]), _keys(added, columns[1:]))
+        self.total_counts.add(['total'] * (len(gone) + len(new)), [key[0] for key in gone + new],
+                              [-1] * len(gone) + [1] * len(new))
+        return self
+
+    def per_theme(self, min_year, max_year):
+        """Pivot of years (rows, from the first to the last year with a release) by parent theme (columns)."""
+        df_pivot = self.per_theme_counts.frame(min_year, max_year)
+        df_pivot = df_pivot.loc[:, df_pivot.sum() > 0]
+        df_pivot = df_pivot[sorted(df_pivot.columns)]
+        released = df_pivot.index[df_pivot.sum(axis=1).to_numpy() > 0]
+        if not len(released):
+            return df_pivot.iloc[:0]
+        return df_pivot.loc[released.min():released.max()]
+
+    def total(self, min_year, max_year):
+        """Years with a release and their number of distinct sets."""
+        df_total = self.total_counts.frame(min_year, max_year).reset_index()
+        df_total = df_total.rename(columns={'total': 'nbr_sets'}) if 'total' in df_total else df_total.assign(nbr_sets=0)
+        return df_total[df_total.nbr_sets > 0].reset_index(drop=True)
+
+
+def get_theme_year_index():
+    return get_schema().index(ThemeYearIndex)
+
+
+class TopSetsIndex:
+    """The TOP_SETS largest sets (by number of parts) of every year, overall and per parent theme.
+
+    Sets with the same year, parent theme and name count as one, whose number
+    of parts is the sum of their distinct numbers of parts. Ranks are dense,
+    so tied sets share a rank and a year can have more than k rows.
+
+    The ranked sets are kept as two flat frames, one ordered by year and one
+    by parent theme and year, so a query is a binary search and a slice. An
+    update only re-ranks the years it touches.
+    """
+
+    COLUMNS = ['year', 'parent_theme_name', 'set_name', 'num_parts']
+
+    def __init__(self, sets, k=TOP_SETS):
+        self.k = k
+        # year -> occurrences of each distinct (year, parent_theme_name, set_name, num_parts)
+        self._entries = {}
+        # Sets ranked within their year and within their parent theme, for the years of _entries
+        self._ranked = self._rank(self._occurrences(sets.iloc[:0]))
+        self.update(sets.iloc[:0], sets)
+
+    def copy(self):
+        other = copy.copy(self)
+        other._entries = dict(self._entries)
+        return other
+
+    def _occurrences(self, sets):
+        entries = sets[self.COLUMNS].astype({'year': 'int64', 'num_parts': 'int64', 'parent_theme_name': str, 'set_name': str})
+        return entries.groupby(self.COLUMNS).size()
+
+    def _rank(self, entries):
+        sets = entries.index.to_frame(index=False).groupby(self.COLUMNS[:3]).num_parts.sum().reset_index()
+        sets['rank'] = sets.groupby('year').num_parts.rank(method='dense', ascending=False)
+        sets['theme_rank'] = sets.groupby(['year', 'parent_theme_name']).num_parts.rank(method='dense', ascending=False)
+        sets = sets[(sets['rank'] <= self.k) | (sets.theme_rank <= self.k)]
+        sets.insert(2, 'theme_set', sets.parent_theme_name + ' - ' + sets.set_name)
+        return sets.drop(columns='set_name')
+
+    def update(self, removed, added):
+        changes = pd.concat([-self._occurrences(removed), self._occurrences(added)])
+        changes = changes.groupby(level=list(range(len(self.COLUMNS)))).sum()
+        years = []
+        for year, change in changes.groupby(level='year'):
+            years.append(year)
+            entries = change if year not in self._entries else self._entries[year].add(change, fill_value=0)
+            entries = entries[entries > 0]
+            if len(entries):
+                self._entries[year] = entries
+            else:
+                self._entries.pop(year, None)
+
+        # Only the touched years are ranked again
+        ranked = self._ranked[~self._ranked.year.isin(years)]
+        touched = [self._entries[year] for year in years if year in self._entries]
+        if touched:
+            ranked = pd.concat([ranked, self._rank(pd.concat(touched))])
+        self._ranked = ranked
+        by_year = ranked[ranked['rank'] <= self.k].sort_values(['year', 'rank', 'theme_set'])
+        by_theme = ranked[ranked.theme_rank <= self.k].sort_values(['parent_theme_name', 'year', 'theme_rank', 'theme_set'])
+        names, starts = np.unique(by_theme.parent_theme_name.to_numpy(), return_index=True)
+        bounds = dict(zip(names, zip(starts, list(starts[1:]) + [len(by_theme)])))
+        self._tables = (by_year.reset_index(drop=True), by_theme.reset_index(drop=True), bounds)
+        return self
+
+    def top(self, min_year, max_year, k=None, parent_theme=None):
+        """The k (at most TOP_SETS) largest sets of every year between min_year and max_year, ties included.
+
+        With parent_theme, only the sets of that parent theme are ranked.
+        """
+        k = self.k if k is None else min(k, self.k)
+        by_year, by_theme, bounds = self._tables
+        if parent_theme is None:
+            table, rank = by_year, 'rank'
+        else:
+            lo, hi = bounds.get(parent_theme, (0, 0))
+            table, rank = by_theme.iloc[lo:hi], 'theme_rank'
+        years = table.year.to_numpy()
+        table = table.iloc[np.searchsorted(years, min_year, side='left'):np.searchsorted(years, max_year, side='right')]
+        table = table[table[rank].to_numpy() <= k]
+        return table.drop(columns=['rank', 'theme_rank']).assign(rank=table[rank]).reset_index(drop=True)
+
+
+def get_top_sets_index():
+    return get_schema().index(TopSetsIndex)
+
+
+class ThemePartition:
+    """The sets of one parent theme, ordered by year, with their theme -> set hierarchy."""
+
+    def __init__(self, name, sets):
+        self.name = name
+        self.years = sets.year.to_numpy()
+        self.set_ids = sets.set_id.to_numpy()
+        self.hierarchy = sets[['theme_name', 'set_name']].astype(object).reset_index(drop=True)
+        self.set_name_codes = pd.factorize(self.hierarchy.set_name)[0]
+
+    def sets(self):
+        """The partition's rows as a frame of year, set_id, theme_name and set_name."""
+        return self.hierarchy.assign(year=self.years, set_id=self.set_ids)
+
+    def _bounds(self, min_year, max_year):
+        return (np.searchsorted(self.years, min_year, side='left'),
+                np.searchsorted(self.years, max_year, side='right'))
+
+    def set_ids_between(self, min_year, max_year):
+        lo, hi = self._bounds(min_year, max_year)
+        return self.set_ids[lo:hi]
+
+    def nbr_sets(self, min_year, max_year):
+        """Number of distinct set names released between min_year and max_year."""
+        lo, hi = self._bounds(min_year, max_year)
+        codes = self.set_name_codes[lo:hi]
+        return len(np.unique(codes[codes >= 0]))
+
+    def tree(self, min_year, max_year):
+        """Distinct (parent_theme_name, theme_name, set_name) paths in the year range, each with nbr=1."""
+        lo, hi = self._bounds(min_year, max_year)
+        df_tree = self.hierarchy[lo:hi].drop_duplicates().dropna()
+        df_tree.insert(0, 'parent_theme_name', self.name)
+        df_tree['nbr'] = 1
+        return df_tree.reset_index(drop=True)
+
+
+class ThemePartitions:
+    """Set table partitioned by parent theme, so a parent theme query only reads its own sets."""
+
+    def __init__(self, sets):
+        self._no_sets = sets.iloc[:0]
+        self.partitions = {
+            str(name): ThemePartition(str(name), sets.iloc[positions])
+            for name, positions in sets.groupby('parent_theme_name', observed=True).indices.items()
+        }
+
+    def copy(self):
+        # update() replaces the partitions dict instead of changing it
+        return copy.copy(self)
+
+    def update(self, removed, added):
+        """Rebuild the partitions of the parent themes touched by the removed and added sets."""
+        partitions = dict(self.partitions)
+        removed_ids = removed.set_id.to_numpy()
+        added = added[added.parent_theme_name.notna()]
+        added_names = added.parent_theme_name.astype(str)
+        for name in set(removed.parent_theme_name.dropna().astype(str)) | set(added_names):
+            kept = self[name].sets()
+            kept = kept[~np.isin(kept.set_id.to_numpy(), removed_ids)]
+            sets = pd.concat([kept, added[added_names == name][['year', 'set_id', 'theme_name', 'set_name']].astype({'theme_name': object, 'set_name': object})])
+            sets = sets.take(np.argsort(sets.year.to_numpy(), kind='stable'))
+            if len(sets):
+                partitions[name] = ThemePartition(name, sets)
+            else:
+                partitions.pop(name, None)
+        self.partitions = dict(sorted(partitions.items()))
+        return self
+
+    def __getitem__(self, name):
+        """Partition of a parent theme; unknown themes get an empty partition."""
+        if name not in self.partitions:
+            return ThemePartition(name, self._no_sets)
+        return self.partitions[name]
+
+    def ranked(self, min_year, max_year):
+        """Parent themes with sets in the year range and their number of distinct set names, largest first."""
+        partitions = self.partitions
+        counts = pd.DataFrame({
+            'parent_theme_name': list(partitions),
+            'nbr_sets': [partition.nbr_sets(min_year, max_year) for partition in partitions.values()],
+        })
+        counts = counts[counts.nbr_sets > 0].sort_values('parent_theme_name')
+        return counts.sort_values('nbr_sets', ascending=False, kind='stable').reset_index(drop=True)
+
+
+def get_theme_partitions():
+    return get_schema().index(ThemePartitions)
@@ -0,0 +1,23 @@
+"""Add newer catalogue data to the dashboard without reloading the whole dataset.
+
+Usage: python -m lego.ingest new_sets.csv [more.csv ...]
+
+Each CSV becomes a delta (see lego.data.ingest_delta). Running servers pick it
+up on their next rerun and update the dataset and its indexes with the delta
+only.
+"""
+import argparse
+
+from lego.data import ingest_delta
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('sources', nargs='+', help='CSV files (or URLs) with the part rows of new or changed sets')
+    args = parser.parse_args()
+    for source in args.sources:
+        print(f'{source} -> {ingest_delta(source)}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+"""Opt-in timing and memory instrumentation of the dashboard pages.
+
+Set LEGO_INSTRUMENTATION=1 to enable it. Each page then calls begin() when
+it starts and finish() when it ends, and every stage in between records:
+
+- its wall time;
+- the memory it allocated, net and at its peak (through tracemalloc);
+- the number of rows, or plotted points, of its output.
+
+The stages are data loading, index building, the cached queries and figure
+builders, model fitting, and the page's own rendering blocks. Cached
+functions are timed inside the cache, so they only show up on a cache miss,
+when they actually compute something.
+
+finish() shows the stages of the rerun in a sidebar diagnostics panel and
+appends them, one JSON object per stage, to LOG_PATH for offline analysis.
+
+tracemalloc traces every thread, so allocations of sessions running at the
+same time are mixed together. When instrumentation is disabled, stage() and
+timed() do nothing.
+"""
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+
+import pandas as pd
+import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+from lego.data import DATA_DIR
+
+ENABLED = os.environ.get('LEGO_INSTRUMENTATION', '').lower() in ('1', 'true', 'yes')
+LOG_PATH = Path(os.environ.get('LEGO_INSTRUMENTATION_LOG', DATA_DIR / 'instrumentation.jsonl'))
+
+_local = threading.local()
+_log_lock = threading.Lock()
+
+
+class Stage:
+    """Measurements of one stage of a rerun."""
+
+    def __init__(self, name, depth):
+        self.name = name
+        self.depth = depth
+        self.rows = None
+        self._start = time.perf_counter()
+        self._memory = tracemalloc.get_traced_memory()[0]
+        self._peak = self._memory
+
+    def set_rows(self, result):
+        """Record the size of result: rows of a frame (or frames), or points of a plotly figure."""
+        self.rows = _rows(result)
+
+    def _observe_peak(self):
+        self._peak = max(self._peak, tracemalloc.get_traced_memory()[1])
+
+    def close(self):
+        self.ms = (time.perf_counter() - self._start) * 1000
+        self._observe_peak()
+        memory = tracemalloc.get_traced_memory()[0]
+        self.alloc_kib = (memory - self._memory) / 1024
+        self.peak_kib = (self._peak - self._memory) / 1024
+
+
+class _NoStage:
+    def set_rows(self, result):
+        pass
+
+
+class Run:
+    """Stages recorded during one rerun of a page."""
+
+    def __init__(self, page):
+        self.page = page
+        self.id = uuid.uuid4().hex
+        self.stages = []
+        self.open = []
+        self.start = time.perf_counter()
+
+    def push(self, name):
+        # tracemalloc keeps a single peak, so it is reset per stage and each enclosing stage keeps its own maximum
+        if self.open:
+            self.open[-1]._observe_peak()
+        tracemalloc.reset_peak()
+        stage = Stage(name, len(self.open))
+        self.stages.append(stage)
+        self.open.append(stage)
+        return stage
+
+    def pop(self, stage):
+        stage.close()
+        self.open.remove(stage)
+        if self.open:
+            self.open[-1]._peak = max(self.open[-1]._peak, stage._peak)
+
+
+def _rows(result):
+    if isinstance(result, (pd.DataFrame, pd.Series)):
+        return len(result)
+    if isinstance(result, tuple) and all(isinstance(item, (pd.DataFrame, pd.Series)) for item in result):
+        return sum(len(item) for item in result)
+    data = getattr(result, 'data', None)
+    if isinstance(data, tuple):
+        # Plotly figure: number of plotted points over all traces
+        return sum(len(next((v for v in (getattr(t, 'x', None), getattr(t, 'labels', None)) if v is not None), ())) for t in data)
+    return None
+
+
+def _current_run():
+    return getattr(_local, 'run', None)
+
+
+def begin(page):
+    """Start recording the stages of this rerun of page; does nothing unless instrumentation is enabled."""
+    if not ENABLED:
+        return
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+    _local.run = Run(page)
+
+
+@contextmanager
+def stage(name):
+    """Record the block as a stage of the current rerun; the stage's set_rows records its output size."""
+    run = _current_run()
+    if run is None:
+        yield _NoStage()
+        return
+    current = run.push(name)
+    try:
+        yield current
+    finally:
+        run.pop(current)
+
+
+def timed(kind):
+    """Decorator recording every call of the function as a '<kind>: <name>' stage, with the rows of its result."""
+    def decorator(func):
+        name = f'{kind}: {func.__name__.lstrip("_")}'
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _current_run() is None:
+                return func(*args, **kwargs)
+            with stage(name) as current:
+                result = func(*args, **kwargs)
+                current.set_rows(result)
+                return result
+        return wrapper
+    return decorator
+
+
+def _records(run, total_ms):
+    ctx = get_script_run_ctx()
+    common = {'ts': datetime.now(timezone.utc).isoformat(timespec='milliseconds'), 'run': run.id, 'page': run.page,
+              'session': ctx.session_id if ctx else None}
+    records = [{**common, 'stage': s.name, 'depth': s.depth, 'ms': round(s.ms, 3), 'alloc_kib': round(s.alloc_kib, 1),
+                'peak_kib': round(s.peak_kib, 1), 'rows': s.rows} for s in run.stages]
+    records.append({**common, 'stage': 'total', 'depth': 0, 'ms': round(total_ms, 3), 'alloc_kib': None,
+                    'peak_kib': None, 'rows': None})
+    return records
+
+
+def write_log(records, path=LOG_PATH):
+    """Append records to the JSON-lines log at path."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    lines = ''.join(json.dumps(record) + '\n' for record in records)
+    with _log_lock, open(path, 'a') as f:
+        f.write(lines)
+
+
+def finish():
+    """End the current rerun: show its stages in the sidebar and append them to the log."""
+    run = _current_run()
+    if run is None:
+        return
+    _local.run = None
+    total_ms = (time.perf_counter() - run.start) * 1000
+    records = _records(run, total_ms)
+    write_log(records)
+
+    with st.sidebar.expander('Diagnostics', expanded=False):
+        st.caption(f'Rerun took {total_ms:,.0f} ms. Cached results are not listed, as they computed nothing.')
+        df_stages = pd.DataFrame(records[:-1], columns=['stage', 'depth', 'ms', 'alloc_kib', 'peak_kib', 'rows'])
+        df_stages['stage'] = ['  ' * depth + name for depth, name in zip(df_stages.depth, df_stages.stage)]
+        st.dataframe(df_stages.drop(columns='depth'), use_container_width=True)
@@ -0,0 +1,181 @@
+"""Background jobs of the Forecaster: PNG export and webhook delivery.
+
+Rendering a figure through kaleido and posting to a webhook are both slow, so
+neither runs on the script thread. The page submits a job to a process-wide
+queue of worker threads and reads the job's state on later reruns.
+
+PNG exports are rendered only when a job asks for them, and are stored under
+EXPORT_DIR in a file named after the hash of the figure's content. A figure
+that was already exported is therefore not rendered again, and concurrent
+sessions never write to each other's files.
+
+Webhook messages go through a delivery backend chosen by LEGO_WEBHOOK_BACKEND:
+'discord' (the default) uses discord.py's SyncWebhook, and 'http' posts plain
+HTTP requests, so a local stub server can stand in for Discord. Failed sends
+are retried with exponential backoff.
+
+Worker threads run outside any script run, so Streamlit's caches are not
+available to the job functions.
+"""
+import hashlib
+import itertools
+import json
+import os
+import tempfile
+import threading
+import time
+import urllib.request
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import streamlit as st
+
+from lego.data import DATA_DIR
+
+EXPORT_DIR = DATA_DIR / 'exports'
+# Number of worker threads running jobs
+JOB_WORKERS = int(os.environ.get('LEGO_JOB_WORKERS', 2))
+# Number of finished jobs whose state is kept
+JOB_HISTORY = int(os.environ.get('LEGO_JOB_HISTORY', 256))
+# Delivery backend of webhook messages ('discord' or 'http')
+WEBHOOK_BACKEND = os.environ.get('LEGO_WEBHOOK_BACKEND', 'discord')
+# Attempts per webhook message, and the delay (in seconds) before the first retry; later retries double it
+SEND_ATTEMPTS = int(os.environ.get('LEGO_SEND_ATTEMPTS', 4))
+SEND_BACKOFF = float(os.environ.get('LEGO_SEND_BACKOFF', 1.0))
+
+
+class DeliveryError(Exception):
+    """A webhook message could not be delivered; the send may be retried."""
+
+
+class DiscordBackend:
+    """Sends through a Discord webhook URL."""
+
+    def send(self, url, content=None, file_path=None):
+        from discord import File, HTTPException, SyncWebhook
+
+        webhook = SyncWebhook.from_url(url)
+        try:
+            if file_path is None:
+                webhook.send(content)
+            else:
+                webhook.send(content, file=File(file_path))
+        except HTTPException as exc:
+            raise DeliveryError(str(exc)) from exc
+
+
+class HttpBackend:
+    """Posts messages to url as JSON ({"content": ...}) and files as raw bytes.
+
+    File uploads carry the file name in the X-Filename header. This is enough
+    for a local stub server to record what would have been sent to Discord.
+    """
+
+    timeout = 10
+
+    def send(self, url, content=None, file_path=None):
+        if content is not None:
+            self._post(url, json.dumps({'content': content}).encode(), {'Content-Type': 'application/json'})
+        if file_path is not None:
+            with open(file_path, 'rb') as f:
+                body = f.read()
+            headers = {'Content-Type': 'application/octet-stream', 'X-Filename': os.path.basename(file_path)}
+            self._post(url, body, headers)
+
+    def _post(self, url, body, headers):
+        request = urllib.request.Request(url, data=body, headers=headers, method='POST')
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            if response.status >= 300:
+                raise DeliveryError(f'{url} answered {response.status}')
+
+
+BACKENDS = {'discord': DiscordBackend, 'http': HttpBackend}
+
+
+def get_backend(name=None):
+    """Delivery backend registered under name (WEBHOOK_BACKEND by default)."""
+    name = name or WEBHOOK_BACKEND
+    if name not in BACKENDS:
+        raise ValueError(f'Unknown webhook backend {name!r}, expected one of {sorted(BACKENDS)}')
+    return BACKENDS[name]()
+
+
+def send_with_retry(backend, url, content=None, file_path=None, attempts=SEND_ATTEMPTS, backoff=SEND_BACKOFF):
+    """backend.send, retried with exponential backoff on delivery and network errors."""
+    for attempt in range(attempts):
+        try:
+            return backend.send(url, content=content, file_path=file_path)
+        except (DeliveryError, OSError):
+            if attempt == attempts - 1:
+                raise
+            time.sleep(backoff * 2 ** attempt)
+
+
+def figure_hash(fig):
+    """Hash of a figure's full JSON, identifying its rendered content."""
+    return hashlib.sha1(fig.to_json().encode()).hexdigest()
+
+
+def export_png(fig, export_dir=EXPORT_DIR):
+    """Path of fig rendered as PNG, rendering it only if no export of the same content exists."""
+    path = export_dir / f'{figure_hash(fig)}.png'
+    if not path.exists():
+        export_dir.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(suffix='.png', dir=export_dir)
+        os.close(fd)
+        try:
+            fig.write_image(tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    return path
+
+
+def send_figure(fig, url, content, backend=None):
+    """Export fig as PNG and send content, then the image, to the webhook url."""
+    backend = backend or get_backend()
+    path = export_png(fig)
+    send_with_retry(backend, url, content=content)
+    send_with_retry(backend, url, file_path=path)
+    return path
+
+
+class JobQueue:
+    """Runs functions on worker threads and keeps the state of the latest jobs by id."""
+
+    def __init__(self, workers=JOB_WORKERS, history=JOB_HISTORY):
+        self.history = history
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='lego-job')
+        self._futures = OrderedDict()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def submit(self, func, *args, **kwargs):
+        """Queue func(*args, **kwargs) and return the job id."""
+        future = self._executor.submit(func, *args, **kwargs)
+        with self._lock:
+            job_id = next(self._ids)
+            self._futures[job_id] = future
+            # Forget the oldest finished jobs beyond the history size
+            for old_id in [i for i, f in self._futures.items() if f.done()][:max(0, len(self._futures) - self.history)]:
+                del self._futures[old_id]
+        return job_id
+
+    def status(self, job_id):
+        """('queued' | 'running' | 'done' | 'failed' | 'unknown', result or exception or None)."""
+        with self._lock:
+            future = self._futures.get(job_id)
+        if future is None:
+            return 'unknown', None
+        if not future.done():
+            return ('running' if future.running() else 'queued'), None
+        if future.exception() is not None:
+            return 'failed', future.exception()
+        return 'done', future.result()
+
+
+@st.cache_resource(show_spinner=False)
+def get_job_queue():
+    """Process-wide JobQueue shared by every session."""
+    return JobQueue()
@@ -0,0 +1,138 @@
+"""Aggregations shared by the dashboard pages.
+
+Every query takes the year range selected in the sidebar. Results are kept in
+a bounded LRU cache shared by all sessions and keyed by the query parameters
+and the dataset version, so a rerun with parameters seen before (by any user)
+does not recompute anything.
+"""
+import os
+
+import pandas as pd
+import streamlit as st
+
+from lego import instrumentation
+from lego.indexes import get_theme_partitions, get_theme_year_index, get_top_sets_index
+from lego.schema import get_schema
+
+# Maximum number of cached results per query
+QUERY_CACHE_SIZE = int(os.environ.get('LEGO_QUERY_CACHE_SIZE', 256))
+
+
+def _cached(func):
+    return st.cache_data(max_entries=QUERY_CACHE_SIZE, show_spinner=False)(instrumentation.timed('query')(func))
+
+
+def _sets(year_range):
+    return get_schema().sets_between(*year_range)
+
+
+@_cached
+def _parent_themes_ranked(version, year_range):
+    # Steps 1 and 2, counted per parent theme partition
+    return get_theme_partitions().ranked(*year_range)
+
+
+def parent_themes_ranked(year_range):
+    """Parent themes with their number of distinct set names, largest first."""
+    return _parent_themes_ranked(get_schema().version, tuple(year_range))
+
+
+@_cached
+def _sets_per_parent_theme(version, year_range, top_n):
+    df_themes_to_parts = parent_themes_ranked(year_range)
+    sets_per_parent_theme = df_themes_to_parts[:top_n].copy()
+    # Step 3
+    nbr_sets_remained = df_themes_to_parts[top_n:].nbr_sets.sum()
+    # Create a single row dataframe with Index = top_n
+    df_single_row = pd.DataFrame({'parent_theme_name': 'Remainder', 'nbr_sets': nbr_sets_remained}, index=[top_n])
+    # Step 5
+    return pd.concat([sets_per_parent_theme, df_single_row])
+
+
+def sets_per_parent_theme(year_range, top_n):
+    """Number of sets of the top_n parent themes, followed by a 'Remainder' row for all the others."""
+    return _sets_per_parent_theme(get_schema().version, tuple(year_range), top_n)
+
+
+@_cached
+def _new_sets_per_year(version, year_range, top_n):
+    df_sets = _sets(year_range)
+    top_themes = parent_themes_ranked(year_range).parent_theme_name[:top_n]
+    # Step 1
+    sets_master_themes_per_first_year = df_sets.groupby(['parent_theme_name', 'set_name'], observed=True)['year'].min().reset_index()
+    # Step 2
+    sets_per_year_master_theme = sets_master_themes_per_first_year.groupby(['year', 'parent_theme_name'], observed=True)['set_name'].nunique().reset_index()
+    sets_per_year_master_theme['parent_theme_name'] = sets_per_year_master_theme['parent_theme_name'].astype(str)
+    # Step 3
+    is_top = sets_per_year_master_theme['parent_theme_name'].isin(top_themes)
+    sets_per_year_master_theme_top = sets_per_year_master_theme[is_top].sort_values('parent_theme_name')
+    # Step 5
+    sets_per_year_master_theme_remainder = sets_per_year_master_theme[~is_top].groupby('year')['set_name'].sum().reset_index()
+    sets_per_year_master_theme_remainder['parent_theme_name'] = 'Remainder'
+    # Step 6
+    return pd.concat([sets_per_year_master_theme_top, sets_per_year_master_theme_remainder])
+
+
+def new_sets_per_year(year_range, top_n):
+    """New sets per year (column set_name) of the top_n parent themes, with the others summed as 'Remainder'."""
+    return _new_sets_per_year(get_schema().version, tuple(year_range), top_n)
+
+
+@_cached
+def _top_sets_per_year(version, year_range, k, parent_theme):
+    # Steps 1 to 5, ranked per year by the index
+    return get_top_sets_index().top(*year_range, k=k, parent_theme=parent_theme)
+
+
+def top_sets_per_year(year_range, k=1, parent_theme=None):
+    """The k largest sets (by number of parts) of every year, ties included, optionally of one parent theme only."""
+    return _top_sets_per_year(get_schema().version, tuple(year_range), k, parent_theme)
+
+
+@_cached
+def _sets_table(version, year_range):
+    return _sets(year_range)[['year', 'parent_theme_name', 'theme_name', 'set_name', 'num_parts']].drop_duplicates()
+
+
+def sets_table(year_range):
+    """One row per distinct set with its year, themes and number of parts."""
+    return _sets_table(get_schema().version, tuple(year_range))
+
+
+@_cached
+def _theme_tree(version, year_range, theme):
+    # Steps 2 to 4, reading only the chosen theme's partition
+    return get_theme_partitions()[theme].tree(*year_range)
+
+
+def theme_tree(year_range, theme):
+    """Distinct (parent theme, theme, set) paths of one parent theme, each with nbr=1."""
+    return _theme_tree(get_schema().version, tuple(year_range), theme)
+
+
+@instrumentation.timed('query')
+def theme_parts_table(year_range, theme):
+    """Part-level rows of the sets of one parent theme."""
+    theme_set_ids = get_theme_partitions()[theme].set_ids_between(*year_range)
+    return get_schema().part_rows(theme_set_ids)[['parent_theme_name', 'theme_name', 'year', 'set_num', 'set_name', 'num_parts', 'part_num', 'part_name', 'part_category_name', 'quantity', 'color_name', 'is_trans']].drop_duplicates()
+
+
+@_cached
+def _new_sets_per_year_total(version, year_range):
+    return get_theme_year_index().total(*year_range)
+
+
+def new_sets_per_year_total(year_range):
+    """Number of distinct sets released per year, across all themes."""
+    return _new_sets_per_year_total(get_schema().version, tuple(year_range))
+
+
+@_cached
+def _new_sets_per_year_by_parent_theme(version, year_range):
+    # Years without any release are kept as zeros, so every column is a complete yearly series
+    return get_theme_year_index().per_theme(*year_range)
+
+
+def new_sets_per_year_by_parent_theme(year_range):
+    """Distinct sets released per year (rows) and parent theme (columns), in one pivot."""
+    return _new_sets_per_year_by_parent_theme(get_schema().version, tuple(year_range))
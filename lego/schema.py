@@ -0,0 +1,220 @@
+"""Normalized view of the part-level dataset.
+
+The combined CSV repeats every theme and set column on each of its part rows.
+LegoSchema splits it once at load time into:
+
+- themes: one row per (parent_theme_name, theme_name), keyed by theme_id
+- sets: one row per set, keyed by set_id and ordered by year; the theme names
+  are carried along so set-level charts never need a join
+- parts: the part rows, referencing sets through set_id; stored as chunks,
+  each ordered by set_id
+
+Snapshots are written ordered by set (see lego.data.SET_ORDER), so the first
+parts chunk is the memory-mapped snapshot frame itself, next to an array of
+its set ids: part rows are only copied when a query selects them.
+
+Set-level charts work on sets only and never touch part rows.
+
+Deltas (see lego.data) are applied incrementally by LegoSchema.with_delta:
+the delta's part rows become a new chunk, and only the set and theme tables,
+which are far smaller than the parts, are merged. Indexes built on a schema
+(see LegoSchema.index) are copied and updated with the changed sets instead
+of being rebuilt.
+"""
+import copy
+import threading
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+from lego import instrumentation
+from lego.data import dataset_version, delta_names, read_delta, read_snapshot
+
+THEME_COLUMNS = ['parent_theme_name', 'theme_name']
+SET_COLUMNS = ['year', 'set_num', 'set_name', 'num_parts']
+
+
+def _dimension(keys, key_name):
+    """Integer key of every row of keys, and the table of distinct key rows ordered by it."""
+    ids = keys.groupby(list(keys.columns), observed=True, sort=True, dropna=False).ngroup().to_numpy(np.int32)
+    first = ~pd.Series(ids).duplicated().to_numpy()
+    table = keys[first].set_axis(ids[first]).sort_index().rename_axis(key_name).reset_index()
+    return ids, table
+
+
+def _columns(df, columns, rows=None):
+    """New frame of the given columns of df, taking only the given row positions if any.
+
+    Unlike df[columns] or df.take(rows), this leaves df's blocks alone: pandas
+    consolidates them first, which copies a memory-mapped frame onto the heap.
+    """
+    return pd.DataFrame({col: df[col].array if rows is None else df[col].array.take(rows) for col in columns})
+
+
+def _part_chunk(df, set_ids):
+    """(set ids, part rows) of df, ordered by set id.
+
+    Frames written by lego.data are already in that order and are used as
+    they are, without copying. Older snapshots are reordered, which copies
+    every part row onto the heap.
+    """
+    if np.all(set_ids[1:] >= set_ids[:-1]):
+        return set_ids, df
+    order = np.argsort(set_ids, kind='stable')
+    return set_ids[order], _columns(df, df.columns, order)
+
+
+def concat_frames(frames):
+    """pd.concat of frames with the same columns, keeping categorical columns categorical.
+
+    Categorical columns get the sorted union of the frames' categories, so
+    category codes keep following the order of the values (lego.table sorts
+    categorical columns by code).
+    """
+    frames = list(frames)
+    if len(frames) == 1:
+        return frames[0].reset_index(drop=True)
+    for col in frames[0].columns:
+        if not isinstance(frames[0][col].dtype, pd.CategoricalDtype):
+            continue
+        categories = frames[0][col].cat.categories
+        for frame in frames[1:]:
+            values = frame[col]
+            other = values.cat.categories if isinstance(values.dtype, pd.CategoricalDtype) else pd.Index(values.dropna().unique())
+            categories = categories.append(other.difference(categories))
+        categories = categories.sort_values()
+        frames = [frame.assign(**{col: frame[col].astype(pd.CategoricalDtype(categories))}) for frame in frames]
+    return pd.concat(frames, ignore_index=True)
+
+
+class LegoSchema:
+    """Theme dimension, set dimension and parts fact table built from the part-level frame."""
+
+    def __init__(self, df, version=None):
+        self.version = version
+
+        theme_ids, self.themes = _dimension(_columns(df, THEME_COLUMNS), 'theme_id')
+
+        set_keys = _columns(df, SET_COLUMNS).assign(theme_id=theme_ids)
+        set_ids, sets = _dimension(set_keys, 'set_id')
+        theme_names = self.themes[THEME_COLUMNS].take(sets.theme_id).reset_index(drop=True)
+        self.sets = pd.concat([sets, theme_names], axis=1)
+        self._set_positions = np.arange(len(self.sets))
+
+        self.part_columns = [col for col in df.columns if col not in THEME_COLUMNS + SET_COLUMNS]
+        self.part_chunks = [_part_chunk(df, set_ids)]
+
+        self._indexes = {}
+        self._lock = threading.Lock()
+
+    def year_bounds(self):
+        """First and last year with a set release."""
+        return int(self.sets.year.iloc[0]), int(self.sets.year.iloc[-1])
+
+    def sets_between(self, min_year, max_year):
+        """Sets released between min_year and max_year (both inclusive).
+
+        The set table is ordered by year, so the range is found by binary search
+        instead of a boolean mask over every row.
+        """
+        years = self.sets.year.to_numpy()
+        lo = np.searchsorted(years, min_year, side='left')
+        hi = np.searchsorted(years, max_year, side='right')
+        return self.sets.iloc[lo:hi]
+
+    def part_rows(self, set_ids):
+        """Part-level rows of the given sets, with their set and theme columns joined back in."""
+        set_ids = np.unique(np.asarray(set_ids))
+        chunks = []
+        for part_set_ids, chunk in self.part_chunks:
+            # Each chunk is ordered by set_id, so each set's rows are one contiguous slice
+            starts = np.searchsorted(part_set_ids, set_ids, side='left')
+            ends = np.searchsorted(part_set_ids, set_ids, side='right')
+            lengths = ends - starts
+            rows = np.arange(lengths.sum()) + np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+            if len(rows) or not chunks:
+                parts = _columns(chunk, self.part_columns, rows)
+                parts.insert(0, 'set_id', part_set_ids[rows])
+                chunks.append(parts)
+        parts = concat_frames(chunks)
+        set_columns = self.sets.drop(columns='set_id').take(self._set_positions[parts.set_id]).reset_index(drop=True)
+        return pd.concat([set_columns, parts], axis=1)
+
+    def index(self, index_class):
+        """The index_class(sets) index of this schema, built on first use and kept up to date by with_delta."""
+        with self._lock:
+            if index_class not in self._indexes:
+                with instrumentation.stage(f'index: {index_class.__name__}'):
+                    self._indexes[index_class] = index_class(self.sets)
+            return self._indexes[index_class]
+
+    def _theme_ids(self, delta):
+        """theme_id of every delta row; (parent, theme) pairs not seen before are added to the theme table."""
+        keys = _columns(delta, THEME_COLUMNS).astype(str)
+        known = self.themes.astype({col: str for col in THEME_COLUMNS})
+        new = keys.drop_duplicates().merge(known, how='left', on=THEME_COLUMNS)
+        new = new[new.theme_id.isna()].drop(columns='theme_id').reset_index(drop=True)
+        new.insert(0, 'theme_id', np.arange(len(self.themes), len(self.themes) + len(new)))
+        self.themes = concat_frames([self.themes, new])
+        known = self.themes.astype({col: str for col in THEME_COLUMNS})
+        return keys.merge(known, how='left', on=THEME_COLUMNS).theme_id.to_numpy(np.int32)
+
+    def with_delta(self, delta, version):
+        """New schema with the sets of delta added, replacing earlier sets with the same set_num.
+
+        Indexes built on this schema are copied and updated with the removed
+        and added sets for the new schema. This schema and its indexes are
+        left unchanged, so sessions still on its version keep reading it.
+        """
+        schema = copy.copy(self)
+        schema.version = version
+        schema._lock = threading.Lock()
+
+        theme_ids = schema._theme_ids(delta)
+        set_keys = _columns(delta, SET_COLUMNS).assign(theme_id=theme_ids)
+        local_ids, added = _dimension(set_keys, 'set_id')
+        first_id = len(self._set_positions)
+        added['set_id'] += first_id
+        theme_names = schema.themes[THEME_COLUMNS].take(added.theme_id).reset_index(drop=True)
+        added = pd.concat([added, theme_names], axis=1)
+
+        replaced = self.sets.set_num.isin(delta.set_num.astype(str).unique()).to_numpy()
+        removed = self.sets[replaced]
+        sets = concat_frames([self.sets[~replaced], added])
+        schema.sets = sets.take(np.argsort(sets.year.to_numpy(), kind='stable')).reset_index(drop=True)
+        schema._set_positions = np.full(first_id + len(added), -1)
+        schema._set_positions[schema.sets.set_id.to_numpy()] = np.arange(len(schema.sets))
+
+        schema.part_chunks = self.part_chunks + [_part_chunk(delta, local_ids + first_id)]
+
+        with self._lock:
+            indexes = dict(self._indexes)
+        schema._indexes = {index_class: index.copy().update(removed, added) for index_class, index in indexes.items()}
+        return schema
+
+
+# Latest schema built, the starting point for applying newer deltas
+_latest = None
+_latest_lock = threading.Lock()
+
+
+@st.cache_resource(show_spinner=False, max_entries=2)
+@instrumentation.timed('load')
+def _schema(version):
+    global _latest
+    snapshot_version, deltas = version
+    with _latest_lock:
+        schema = _latest
+        if schema is None or schema.version[0] != snapshot_version or deltas[:len(schema.version[1])] != schema.version[1]:
+            schema = LegoSchema(read_snapshot(), (snapshot_version, ()))
+        for i in range(len(schema.version[1]), len(deltas)):
+            with instrumentation.stage(f'load: delta {deltas[i]}'):
+                schema = schema.with_delta(read_delta(deltas[i]), (snapshot_version, deltas[:i + 1]))
+        _latest = schema
+    return schema
+
+
+def get_schema():
+    """Process-wide LegoSchema of the current snapshot and deltas."""
+    return _schema((dataset_version(), delta_names()))
@@ -0,0 +1,172 @@
+"""Server-side paginated table for frames too large to send to the browser.
+
+The full frame stays on the server: search, column filters and sorting are
+evaluated here, and only the rows of the visible page are passed to
+st.dataframe. Exports are written to a temporary file in chunks, and only
+when requested.
+"""
+import math
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import streamlit as st
+
+from lego import instrumentation
+
+PAGE_SIZES = [25, 50, 100, 250]
+EXPORT_CHUNK_ROWS = 50_000
+NO_COLUMN = '(none)'
+
+
+def _is_categorical(values):
+    return isinstance(values.dtype, pd.CategoricalDtype)
+
+
+def search_mask(df, text):
+    """Rows where any text column contains text, ignoring case.
+
+    Categorical columns are searched through their categories, so each distinct
+    value is tested once and rows are then matched by their integer codes.
+    """
+    text = text.lower()
+    mask = np.zeros(len(df), dtype=bool)
+    for col in df.columns:
+        values = df[col]
+        if _is_categorical(values):
+            hits = np.flatnonzero(values.cat.categories.astype(str).str.lower().str.contains(text, regex=False))
+            mask |= np.isin(values.cat.codes.to_numpy(), hits)
+        elif values.dtype == object:
+            mask |= values.astype(str).str.lower().str.contains(text, regex=False).to_numpy()
+    return mask
+
+
+def filter_mask(df, column, selection):
+    """Rows whose column value is in selection, or within the (min, max) selection of a numeric column."""
+    values = df[column]
+    if pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values):
+        return values.between(*selection).to_numpy()
+    if _is_categorical(values):
+        codes = values.cat.categories.get_indexer(list(selection))
+        return np.isin(values.cat.codes.to_numpy(), codes[codes >= 0])
+    return values.isin(list(selection)).to_numpy()
+
+
+def sort_keys(values):
+    """Numeric keys ordering values the same way as sorting them, with missing text values last.
+
+    Categories are ordered by their codes, and other text columns, which may
+    mix strings and NaN, by the position of each value among the sorted
+    distinct values.
+    """
+    if _is_categorical(values):
+        keys = values.cat.codes.to_numpy()
+    elif values.dtype == object:
+        keys = pd.factorize(values, sort=True)[0]
+    else:
+        return values.to_numpy()
+    # Missing values have code -1
+    return np.where(keys < 0, keys.max(initial=-1) + 1, keys)
+
+
+def table_view(df, search='', filter_column=None, filter_selection=None, sort_column=None, ascending=True):
+    """Row positions of df matching the search and filter, in display order."""
+    mask = np.ones(len(df), dtype=bool)
+    if search:
+        mask &= search_mask(df, search)
+    if filter_column is not None and filter_selection is not None:
+        mask &= filter_mask(df, filter_column, filter_selection)
+    positions = np.flatnonzero(mask)
+    if sort_column is not None:
+        order = np.argsort(sort_keys(df[sort_column].iloc[positions]), kind='stable')
+        positions = positions[order if ascending else order[::-1]]
+    return positions
+
+
+def iter_csv_chunks(df, chunk_rows=EXPORT_CHUNK_ROWS):
+    """Yield df as CSV text, chunk_rows rows at a time."""
+    for start in range(0, max(len(df), 1), chunk_rows):
+        yield df.iloc[start:start + chunk_rows].to_csv(index=False, header=start == 0)
+
+
+def write_export(df, path, file_format, chunk_rows=EXPORT_CHUNK_ROWS):
+    """Write df to path as 'csv' or 'parquet', converting chunk_rows rows at a time."""
+    if file_format == 'csv':
+        with open(path, 'w', newline='') as f:
+            for chunk in iter_csv_chunks(df, chunk_rows):
+                f.write(chunk)
+        return
+    schema = pa.Schema.from_pandas(df.iloc[:0], preserve_index=False)
+    with pq.ParquetWriter(path, schema) as writer:
+        for start in range(0, len(df), chunk_rows):
+            chunk = df.iloc[start:start + chunk_rows]
+            writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+
+
+def _filter_widget(df, column, key):
+    values = df[column]
+    if pd.api.types.is_bool_dtype(values):
+        return st.multiselect(f'Values of {column}', [True, False], key=f'{key}_filter_values') or None
+    if pd.api.types.is_numeric_dtype(values):
+        values = values.dropna()
+        if values.empty:
+            return None
+        bound = int if pd.api.types.is_integer_dtype(values) else float
+        low, high = bound(values.min()), bound(values.max())
+        if low == high:
+            return None
+        selection = st.slider(f'Range of {column}', low, high, (low, high), key=f'{key}_filter_range')
+        # The full range filters nothing, not even the rows without a value
+        return None if selection == (low, high) else selection
+    options = sorted(values.dropna().unique().tolist())
+    return st.multiselect(f'Values of {column}', options, key=f'{key}_filter_values') or None
+
+
+def _export(df, positions, key, file_name):
+    col1, col2 = st.columns(2)
+    file_format = col1.radio('Export format', ['csv', 'parquet'], horizontal=True, key=f'{key}_export_format')
+    if not col2.button('Prepare export', key=f'{key}_export'):
+        return
+    fd, path = tempfile.mkstemp(suffix=f'.{file_format}')
+    os.close(fd)
+    try:
+        with st.spinner('Writing export...'):
+            write_export(df.iloc[positions], path, file_format)
+        with open(path, 'rb') as f:
+            st.download_button(f'Download {file_format.upper()}', f, file_name=f'{file_name}.{file_format}',
+                               key=f'{key}_download')
+    finally:
+        os.remove(path)
+
+
+@instrumentation.timed('render')
+def paged_table(df, key, file_name='table'):
+    """Show df one page at a time, with server-side search, filter, sort and export.
+
+    key must be unique on the page; it prefixes the keys of the table's widgets.
+    """
+    col1, col2, col3, col4 = st.columns([3, 2, 2, 1])
+    search = col1.text_input('Search', key=f'{key}_search')
+    filter_column = col2.selectbox('Filter by column', [NO_COLUMN] + list(df.columns), key=f'{key}_filter_column')
+    sort_column = col3.selectbox('Sort by', [NO_COLUMN] + list(df.columns), key=f'{key}_sort_column')
+    ascending = col4.radio('Order', ['Asc', 'Desc'], key=f'{key}_order') == 'Asc'
+
+    filter_column = None if filter_column == NO_COLUMN else filter_column
+    filter_selection = _filter_widget(df, filter_column, key) if filter_column else None
+    sort_column = None if sort_column == NO_COLUMN else sort_column
+
+    positions = table_view(df, search, filter_column, filter_selection, sort_column, ascending)
+
+    col1, col2, col3 = st.columns([1, 1, 3])
+    page_size = col1.selectbox('Rows per page', PAGE_SIZES, index=1, key=f'{key}_page_size')
+    n_pages = max(1, math.ceil(len(positions) / page_size))
+    page = col2.number_input('Page', 1, n_pages, 1, 1, key=f'{key}_page')
+    start = (page - 1) * page_size
+    end = min(start + page_size, len(positions))
+    col3.caption(f'Rows {min(start + 1, end)}-{end} of {len(positions):,} (page {page} of {n_pages})')
+
+    st.dataframe(df.iloc[positions[start:end]], use_container_width=True)
+    _export(df, positions, key, file_name)
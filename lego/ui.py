@@ -0,0 +1,35 @@
+"""Widgets shared by the dashboard pages."""
+import streamlit as st
+
+from lego.schema import get_schema
+
+# Default values of the pages' widgets; lego.warmup fills the caches of the views they select
+DEFAULT_TOP_N = 10
+DEFAULT_K_LARGEST = 1
+DEFAULT_ORDER = (0, 0, 0)
+
+
+def year_range_sidebar():
+    """Draw the sidebar filters and return the selected (start year, end year).
+
+    The slider spans the years of the dataset, so it grows with ingested deltas.
+    """
+    first_year, last_year = get_schema().year_bounds()
+    with st.sidebar:
+        st.header('Filters', anchor=None)
+        values = st.slider(
+            'Select the Start and End Years',
+            first_year, last_year, (first_year, last_year))
+        st.write('Date Range: '+str(values[0])+'-01-01 to '+str(values[1])+'-01-01')
+    return values
+
+
+def sections_sidebar(sections):
+    """Draw a sidebar checkbox per page section and return {key: shown}.
+
+    Streamlit does not tell the script whether an expander is collapsed, so
+    sections are hidden from here instead, and the page skips computing them.
+    """
+    with st.sidebar:
+        st.subheader('Sections', anchor=None)
+        return {key: st.checkbox(title, value=True, key=f'show_{key}') for key, title in sections.items()}
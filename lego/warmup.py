@@ -0,0 +1,111 @@
+"""Start the dashboard with warm caches.
+
+Usage: python -m lego.warmup [streamlit run options, e.g. --server.port 8501]
+
+Before the server starts, warm_caches() loads the dataset, builds its indexes
+and computes what each page shows with its default widget values (see
+lego.ui): the full year range, the default Top N and K largest sets, the
+largest parent theme, and the ARIMA of the default order with its
+stationarity test and correlations. plotly and statsmodels are imported on
+the way, so the first visitor after a deploy does not wait for them either.
+
+Streamlit's caches are only used inside a script run, so the warm-up runs on
+a thread with a script run context of its own. The server then starts in
+the same process, through Streamlit's own command line, and its sessions
+find the cached results.
+"""
+import logging
+import sys
+import threading
+import time
+from pathlib import Path
+
+from streamlit.runtime.scriptrunner import ScriptRunContext, add_script_run_ctx
+from streamlit.runtime.state import SafeSessionState, SessionState
+from streamlit.runtime.uploaded_file_manager import UploadedFileManager
+
+HOME = Path(__file__).resolve().parent.parent / 'Home.py'
+
+
+def warm_caches():
+    """Compute and cache what the pages show by default; return the seconds spent on each page."""
+    from lego import figures, forecasting, indexes, queries
+    from lego.schema import get_schema
+    from lego.ui import DEFAULT_K_LARGEST, DEFAULT_ORDER, DEFAULT_TOP_N
+
+    timings = {}
+
+    start = time.perf_counter()
+    schema = get_schema()
+    for index_class in (indexes.FirstAppearanceIndex, indexes.ThemePartitions, indexes.ThemeYearIndex, indexes.TopSetsIndex):
+        schema.index(index_class)
+    timings['dataset'] = time.perf_counter() - start
+    values = schema.year_bounds()
+
+    start = time.perf_counter()
+    fig = figures.sets_per_parent_theme_bar(values, DEFAULT_TOP_N)
+    # The first figure sent to a browser also pays for plotly's JSON encoder
+    fig.to_json()
+    figures.new_sets_per_year_bar(values, DEFAULT_TOP_N)
+    figures.top_sets_per_year_plot(values, DEFAULT_K_LARGEST)
+    queries.sets_table(values)
+    timings['Home'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    themes = queries.parent_themes_ranked(values).parent_theme_name
+    if len(themes):
+        figures.theme_sunburst(values, themes.iloc[0])
+    timings['Theme Explorer'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    df_nbr_sets_year, df_train, df_test = forecasting.yearly_sets(values)
+    forecasting.adf_test(df_train.nbr_sets)
+    figures.corr_plot(df_train.nbr_sets, DEFAULT_ORDER[1], plot_pacf=False)
+    figures.corr_plot(df_train.nbr_sets, DEFAULT_ORDER[1], plot_pacf=True)
+    arima_model = forecasting.fit_arima(df_train.nbr_sets, DEFAULT_ORDER)
+    arima_model.predict(start=0, end=len(df_nbr_sets_year) - 1)
+    arima_model.forecast(len(df_test))
+    timings['Forecaster'] = time.perf_counter() - start
+    return timings
+
+
+def run_in_script_context(func):
+    """Call func on a thread with a script run context, so Streamlit's caches are used, and return its result."""
+    ctx = ScriptRunContext(session_id='lego-warmup', _enqueue=lambda msg: None, query_string='',
+                           session_state=SafeSessionState(SessionState()), uploaded_file_mgr=UploadedFileManager(),
+                           page_script_hash='', user_info={'email': None})
+    outcome = {}
+
+    def target():
+        try:
+            outcome['result'] = func()
+        except Exception as exc:
+            outcome['error'] = exc
+
+    thread = threading.Thread(target=target, name='lego-warmup')
+    add_script_run_ctx(thread, ctx)
+    thread.start()
+    thread.join()
+    if 'error' in outcome:
+        raise outcome['error']
+    return outcome['result']
+
+
+def main():
+    from streamlit.web import cli
+
+    # Before the server starts, every cached function warns, when defined, that it falls back to in-memory storage, which it would use anyway
+    cache_logger = logging.getLogger('streamlit.runtime.caching.cache_data_api')
+    level = cache_logger.level
+    cache_logger.setLevel(logging.ERROR)
+    try:
+        timings = run_in_script_context(warm_caches)
+    finally:
+        cache_logger.setLevel(level)
+    print('Caches warmed up in ' + ', '.join(f'{name} {seconds:.1f}s' for name, seconds in timings.items()), flush=True)
+
+    cli.main(args=['run', str(HOME), *sys.argv[1:]], prog_name='streamlit')
+
+
+if __name__ == '__main__':
+    main()
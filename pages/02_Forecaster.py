@@ -1,97 +1,78 @@
 import streamlit as st
-import numpy as np
-import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
-from plotly.express.colors import sample_colorscale
-from datetime import datetime, timedelta
-from discord import SyncWebhook, File
-from statsmodels.tsa.arima.model import ARIMA
-from statsmodels.tsa.stattools import adfuller
-from statsmodels.tsa.stattools import pacf, acf
-from sklearn.metrics import mean_squared_error
+from lego import figures, forecasting, instrumentation, jobs, queries
+from lego.table import paged_table
+from lego.ui import DEFAULT_ORDER, year_range_sidebar
+#statsmodels is slow to import, so lego/forecasting.py only imports it when a test or model is not cached yet
 
 def do_stuff_on_page_load():
     st.set_page_config(layout="wide")
 
-def create_corr_plot(series, plot_pacf=False):
-    corr_array = pacf(series.dropna(), alpha=0.05) if plot_pacf else acf(series.dropna(), alpha=0.05)
-    lower_y = corr_array[1][:,0] - corr_array[0]
-    upper_y = corr_array[1][:,1] - corr_array[0]
-
-    fig = go.Figure()
-    for i in range(len(corr_array[0])):
-        fig.add_scatter(x=(i,i), y=(0,corr_array[0][i]), mode='lines',line_color='#3f3f3f')
-    fig.add_scatter(x=np.arange(len(corr_array[0])), y=corr_array[0], mode='markers', marker_color='#1f77b4',
-                marker_size=12)
-    fig.add_scatter(x=np.arange(len(corr_array[0])), y=upper_y, mode='lines', line_color='rgba(255,255,255,0)')
-    fig.add_scatter(x=np.arange(len(corr_array[0])), y=lower_y, mode='lines',fillcolor='rgba(32, 146, 230,0.3)',
-            fill='tonexty', line_color='rgba(255,255,255,0)')
-    fig.update_traces(showlegend=False)
-    fig.update_xaxes(range=[-1,15])
-    fig.update_yaxes(zerolinecolor='#000000')
-    
-    title='Partial Autocorrelation (PACF)' if plot_pacf else 'Autocorrelation (ACF)'
-    fig.update_layout(title=title)
-    return fig
+def show_job_status(key, done_message):
+    """Show the state of the background job stored under key in session_state, and return its result once done."""
+    if key not in st.session_state:
+        return None
+    state, result = jobs.get_job_queue().status(st.session_state[key])
+    if state == 'done':
+        st.text(done_message)
+        return result
+    if state == 'failed':
+        st.error(f'The job failed: {result}')
+    elif state in ('queued', 'running'):
+        st.text(f'Job {state}...')
+        st.button('Refresh status', key=f'{key}_refresh')
+    return None
 
 do_stuff_on_page_load()
 
+#Time and memory of every stage of the rerun are recorded when LEGO_INSTRUMENTATION=1 (see lego/instrumentation.py)
+instrumentation.begin('Forecaster')
+
 st.header('ARIMA Model Forecaster', anchor=None)
 st.text('In this page you will be able to perform the entire ARIMA flow. Start by choosing the order of differencing that ensures stationarity.')
 
 #Set Sidebar Elements
-with st.sidebar:
-    st.header('Filters', anchor=None)
-    values = st.slider(
-        'Select the Start and End Years',
-        1950, 2017, (1950, 2017))
-    st.write('Date Range: '+str(values[0])+'-01-01 to '+str(values[1])+'-01-01')
+values = year_range_sidebar()
 
-#Import Data
-df = st.session_state['df']
-df_filtered = df[(df.year >= values[0]) & (df.year <= values[1])]
+#Import Data: the dataset is shared with the other pages (so this page also works when opened directly),
+#and the yearly counts are computed and cached across sessions by lego/queries.py
 
 #Make Forecaster (simple ARIMA) and display
-#Prepare Data for Model
-df_nbr_sets_year = df_filtered[['year','set_num']].drop_duplicates().groupby('year').count().reset_index().rename(columns={'set_num':'nbr_sets'})
-df_nbr_sets_year['date']= '31-12-'+df_nbr_sets_year.year.astype(int).astype(str)
-df_nbr_sets_year['date'] = pd.to_datetime(df_nbr_sets_year['date'],dayfirst=True)
-df_nbr_sets_year = df_nbr_sets_year.set_index('date')
-df_nbr_sets_year = df_nbr_sets_year.asfreq(freq='Y')
-df_nbr_sets_year['nbr_sets'] = df_nbr_sets_year.nbr_sets.fillna(0)
-df_train = df_nbr_sets_year.iloc[:-5]
-df_test = df_nbr_sets_year.iloc[-5:]
+#Prepare Data for Model: yearly number of new sets, with the last 5 years held out as the test set (see lego/forecasting.py)
+df_nbr_sets_year, df_train, df_test = forecasting.yearly_sets(values)
 
 with st.container():
-    order_differencing = st.slider('Order of Differencing:',min_value=0, max_value=2, value=0)
+    order_differencing = st.slider('Order of Differencing:',min_value=0, max_value=2, value=DEFAULT_ORDER[1])
     if order_differencing == 0:
         df_train['nbr_sets_diff'] = df_train.nbr_sets
     else:
         df_train['nbr_sets_diff'] = df_train.nbr_sets.diff(order_differencing)
     #Use Augmented Dickey-Fuller test for stationarity check
-    results_adfuller = adfuller(df_train.nbr_sets_diff.dropna())
+    results_adfuller = forecasting.adf_test(df_train.nbr_sets_diff)
     st.text(f'ADF Statistic: {results_adfuller[0]}')
     st.text(f'p-value: {results_adfuller[1]}')
 
     #Print the Differenced timeseries
-    fig_diff = px.line(df_train, 
-              x="year", 
-              y="nbr_sets_diff", 
-              title=f'Number of Sets After {order_differencing} Order Differencing',
-              color_discrete_sequence=px.colors.qualitative.Plotly)
-    fig_diff.update_layout(xaxis_title='Year', yaxis_title='Differenced Number of Parts per Set')
-    st.plotly_chart(fig_diff,use_container_width =True)
-
-    #Plot the ACF and PACF
-    fig_acf = create_corr_plot(df_train['nbr_sets_diff'].dropna(),plot_pacf=False)
-    fig_pacf = create_corr_plot(df_train['nbr_sets_diff'],plot_pacf=True)
+    with instrumentation.stage('figure: fig_diff'):
+        fig_diff = px.line(df_train, 
+                  x="year", 
+                  y="nbr_sets_diff", 
+                  title=f'Number of Sets After {order_differencing} Order Differencing',
+                  color_discrete_sequence=px.colors.qualitative.Plotly)
+        fig_diff.update_layout(xaxis_title='Year', yaxis_title='Differenced Number of Parts per Set')
+    with instrumentation.stage('render: fig_diff'):
+        st.plotly_chart(fig_diff,use_container_width =True)
+
+    #Plot the ACF and PACF. The correlations are cached per (series, order of differencing) by lego/figures.py
+    fig_acf = figures.corr_plot(df_train.nbr_sets, order_differencing, plot_pacf=False)
+    fig_pacf = figures.corr_plot(df_train.nbr_sets, order_differencing, plot_pacf=True)
 
     col1, col2 = st.columns(2)
 
-    with col1:
+    with col1, instrumentation.stage('render: fig_acf'):
         st.plotly_chart(fig_acf,use_container_width =True)
-    with col2:
+    with col2, instrumentation.stage('render: fig_pacf'):
         st.plotly_chart(fig_pacf,use_container_width =True)
 
     #Accept user inputs for the ARIMA
@@ -102,24 +83,47 @@ with st.container():
     #https://docs.streamlit.io/library/api-reference/text/st.text
     st.text('With the ACF and PACF you should have hints to the hyperparameters that could be used on the ARIMA.')
 
-    with col1:
-        #👇Collect the numeric user input from the user via the number_input method. Set minimum value as 0, maximum as 10, set base value as 0 and ste as 1. Pass format='%i' and
-        #print the string 'Insert the value of hyperparameter p' to explain the purpose of this request to the user Store as param_p
-        #https://docs.streamlit.io/library/api-reference/widgets/st.number_input
-        param_p = st.number_input('Insert the value of hyperparameter p', 0, 10, 0, 1, format='%i')
-
-    with col2:
-        #👇Collect the numeric user input from the user via the number_input method. Set minimum value as 0, maximum as 10, set base value as 0 and ste as 1. Pass format='%i' and
-        #print the string 'Insert the value of hyperparameter q' to explain the purpose of this request to the user Store as param_q
-        param_q = st.number_input('Insert the value of hyperparameter q', 0, 10, 0, 1, format='%i')
-    
-    #Initialize and fit your first guess for ARIMA hyperparameters
-    arima = ARIMA(df_train.nbr_sets,order=(param_p,order_differencing,param_q))
-    arima_model = arima.fit()
+    #Choose the hyperparameters by hand, or let the automatic search fit the whole (p, d, q) grid in parallel and rank the candidates
+    search_mode = st.radio('How should the ARIMA hyperparameters be chosen?', ['Manual', 'Automatic search'], horizontal=True)
+
+    if search_mode == 'Automatic search':
+        col_p, col_q, col_criterion = st.columns(3)
+        max_p = col_p.number_input('Maximum value of p', 0, 5, 3, 1, format='%i')
+        max_q = col_q.number_input('Maximum value of q', 0, 5, 3, 1, format='%i')
+        criterion = col_criterion.selectbox('Rank the candidates by', forecasting.RANKING_CRITERIA, format_func=str.upper)
+        with st.spinner('Fitting candidate models...'):
+            df_leaderboard = forecasting.leaderboard(df_train.nbr_sets, df_test.nbr_sets, max_p, 2, max_q)
+        df_leaderboard = df_leaderboard.sort_values(criterion).reset_index(drop=True)
+        st.dataframe(df_leaderboard, use_container_width=True)
+        #🛑 Candidates that failed to fit have no scores, only an error, and are sorted last
+        df_fitted = df_leaderboard[df_leaderboard[criterion].notna()]
+        if len(df_fitted):
+            best = df_fitted.iloc[0]
+            model_order = (int(best.p), int(best.d), int(best.q))
+            st.text(f'Best order by {criterion.upper()}: {model_order}')
+        else:
+            st.warning('None of the candidate models could be fitted (see the error column). Choose the hyperparameters by hand instead.')
+            search_mode = 'Manual'
+
+    if search_mode == 'Manual':
+        with col1:
+            #👇Collect the numeric user input from the user via the number_input method. Set minimum value as 0, maximum as 10, set base value as 0 and ste as 1. Pass format='%i' and
+            #print the string 'Insert the value of hyperparameter p' to explain the purpose of this request to the user Store as param_p
+            #https://docs.streamlit.io/library/api-reference/widgets/st.number_input
+            param_p = st.number_input('Insert the value of hyperparameter p', 0, 10, DEFAULT_ORDER[0], 1, format='%i')
+
+        with col2:
+            #👇Collect the numeric user input from the user via the number_input method. Set minimum value as 0, maximum as 10, set base value as 0 and ste as 1. Pass format='%i' and
+            #print the string 'Insert the value of hyperparameter q' to explain the purpose of this request to the user Store as param_q
+            param_q = st.number_input('Insert the value of hyperparameter q', 0, 10, DEFAULT_ORDER[2], 1, format='%i')
+        model_order = (param_p, order_differencing, param_q)
+
+    #Fit the ARIMA with the chosen hyperparameters. Models are cached per (series, order), so reruns do not refit (see lego/forecasting.py)
+    arima_model = forecasting.fit_arima(df_train.nbr_sets, model_order)
 
     fig_arima = go.Figure()
     fig_arima.add_trace(
-        go.Scatter(
+        figures.scatter(
             x=df_nbr_sets_year.index, 
             y=df_nbr_sets_year.nbr_sets,
             mode='lines', 
@@ -127,34 +131,82 @@ with st.container():
             name="Actual Values"
         ))
     fig_arima.add_trace(
-        go.Scatter(
+        figures.scatter(
             x=df_nbr_sets_year.index, 
-            y=arima_model.predict(start=0,end=67),
+            y=arima_model.predict(start=0,end=len(df_nbr_sets_year)-1),
             mode='lines', 
             line={'dash': 'dash', 'color': px.colors.qualitative.Plotly[1]},
             name="ARIMA Predicted Values"
         ))
 
     fig_arima.update_layout(title= 'Number of New Sets per Year and ARIMA Predictions', xaxis_title='Year', yaxis_title='Number of New Sets')
-    st.plotly_chart(fig_arima,use_container_width =True)
-    #👇Save the fig_arima figure using the same method you applied in 4.1. Save as "arima_forecast.png"
-    fig_arima.write_image('arima_forecast.png')
+    with instrumentation.stage('render: fig_arima'):
+        st.plotly_chart(fig_arima,use_container_width =True)
+    #The PNG of fig_arima is no longer written on every rerun: it is rendered by a background job, only when
+    #exported or sent, and stored once per figure content (see lego/jobs.py)
 
     #Print Test Set RMSE
-    preds_arima = arima_model.forecast(5)
+    preds_arima = arima_model.forecast(len(df_test))
     #👇Output a string with "On the test set, for RMSE is " with the RMSE of the ARIMA predictions at the end of the string. Do this using the text element.
-    st.text("On the test set, for RMSE is " + f"{np.sqrt(mean_squared_error(df_test.nbr_sets,preds_arima)):.2f}")
+    st.text("On the test set, for RMSE is " + f"{forecasting.rmse(df_test.nbr_sets,preds_arima):.2f}")
 
     #👇Create a text_input element that displays 'Insert the Discord Webhook URL here!' to the user and collects its input into a variable named webhook_url
     #https://docs.streamlit.io/library/api-reference/widgets/st.text_input
     webhook_url = st.text_input('Insert the Discord Webhook URL here!')
 
-#👇Create a button that says 'Send Forecasts to Discord'. Once this button is pressed, run the code that connects to the Webhook using the webhook_url variable. 
-#👇Then send the string 'The latest ARIMA forecast is in!' and send the arima_forecast.png file.
-if st.button('Send Forecasts to Discord'):# Replace the ... with the button element
-    webhook = SyncWebhook.from_url(webhook_url)
-    webhook.send('The latest ARIMA forecast is in!')
-    webhook.send(file=File('arima_forecast.png'))
-
-    #👇Output a string to the Dashboard that says 'Forecasts sent!', using a text element.
-    st.text('Forecasts sent!')
+#Exports and sends run on the background job queue; the id of each session's latest job is kept in session_state
+col1, col2 = st.columns(2)
+if col1.button('Export Forecast PNG'):
+    st.session_state['png_job'] = jobs.get_job_queue().submit(jobs.export_png, fig_arima)
+
+#👇Create a button that says 'Send Forecasts to Discord'. Once this button is pressed, send the string 'The latest ARIMA forecast is in!'
+#👇and the forecast PNG to the Webhook in the webhook_url variable. Failed sends are retried with backoff by the job.
+if col2.button('Send Forecasts to Discord'):
+    st.session_state['send_job'] = jobs.get_job_queue().submit(jobs.send_figure, fig_arima, webhook_url, 'The latest ARIMA forecast is in!')
+
+png_path = show_job_status('png_job', 'Forecast PNG ready.')
+if png_path is not None:
+    with open(png_path, 'rb') as f:
+        st.download_button('Download Forecast PNG', f, file_name='arima_forecast.png', mime='image/png')
+#👇Output a string to the Dashboard that says 'Forecasts sent!', using a text element.
+show_job_status('send_job', 'Forecasts sent!')
+
+#Batch Forecast: backtest one ARIMA order on the yearly new sets of every parent theme at once
+st.header('Batch Forecast per Parent Theme', anchor=None)
+st.text('Backtest an ARIMA on every parent theme over several rolling forecast origins, then browse the errors and forecasts.')
+
+col1, col2, col3, col4, col5 = st.columns(5)
+batch_p = col1.number_input('p', 0, 5, 1, 1, format='%i', key='batch_p')
+batch_d = col2.number_input('d', 0, 2, 1, 1, format='%i', key='batch_d')
+batch_q = col3.number_input('q', 0, 5, 0, 1, format='%i', key='batch_q')
+batch_horizon = col4.number_input('Forecast horizon (years)', 1, 10, 5, 1, format='%i', key='batch_horizon')
+batch_origins = col5.number_input('Backtest origins', 1, 10, 3, 1, format='%i', key='batch_origins')
+
+#The backtests are only run on request; results are cached per dataset version and parameters (see lego/forecasting.py)
+if st.checkbox('Run the batch backtests', key='batch_run'):
+    with st.spinner('Backtesting every parent theme...'):
+        df_backtest_metrics, df_backtest_forecasts = forecasting.theme_backtests(
+            values, (batch_p, batch_d, batch_q), batch_horizon, batch_origins)
+    n_failed = int(df_backtest_metrics['error'].notna().sum())
+    st.text(f'{len(df_backtest_metrics) - n_failed} parent themes backtested, {n_failed} skipped (see the error column).')
+    paged_table(df_backtest_metrics, key='batch_table', file_name='lego_theme_backtests')
+
+    scored_themes = df_backtest_metrics[df_backtest_metrics['error'].isna()].sort_values('rmse').parent_theme_name.tolist()
+    if scored_themes:
+        batch_theme = st.selectbox('Chart the forecasts of', scored_themes, key='batch_theme')
+        df_theme_actual = queries.new_sets_per_year_by_parent_theme(values)[batch_theme]
+        df_theme_forecasts = df_backtest_forecasts[df_backtest_forecasts.parent_theme_name == batch_theme]
+
+        fig_batch = go.Figure()
+        fig_batch.add_trace(figures.scatter(x=forecasting.yearly_series(df_theme_actual).index, y=df_theme_actual,
+            mode='lines', line={'color': px.colors.qualitative.Plotly[0]}, name='Actual Values'))
+        for (kind, origin), df_fold in df_theme_forecasts.groupby(['kind', 'origin']):
+            fig_batch.add_trace(figures.scatter(x=df_fold.date, y=df_fold.forecast, mode='lines',
+                line={'dash': 'dash' if kind == 'backtest' else 'solid', 'color': px.colors.qualitative.Plotly[1 if kind == 'backtest' else 2]},
+                name=f'{kind.capitalize()} from {origin.year}'))
+        fig_batch.update_layout(title=f'Number of New Sets per Year for {batch_theme} and ARIMA Backtests', xaxis_title='Year', yaxis_title='Number of New Sets')
+        with instrumentation.stage('render: fig_batch'):
+            st.plotly_chart(fig_batch, use_container_width=True)
+
+#Diagnostics panel in the sidebar, when instrumentation is enabled
+instrumentation.finish()
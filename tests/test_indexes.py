@@ -0,0 +1,177 @@
+"""Indexes kept up to date by LegoSchema.with_delta, checked against full rebuilds and brute force."""
+import numpy as np
+import pandas as pd
+import pytest
+
+from bench.generate import BASE, generate
+from lego import indexes
+from lego.data import CATEGORY_COLUMNS, compact_dtypes
+from lego.schema import LegoSchema
+
+INDEX_CLASSES = [indexes.FirstAppearanceIndex, indexes.ThemeYearIndex, indexes.TopSetsIndex, indexes.ThemePartitions]
+YEAR_RANGES = [(1900, 2100), (1990, 2005), (2018, 2020), (1800, 1900)]
+SMALL = {**BASE, 'sets': 400, 'parent_themes': 8, 'themes': 20, 'parts': 200, 'rows_per_set': 5}
+NEW_THEME = 'AAA New Theme'
+
+
+@pytest.fixture(scope='module')
+def dataset(tmp_path_factory):
+    path = tmp_path_factory.mktemp('data') / 'lego.csv'
+    generate(path, base=SMALL)
+    return compact_dtypes(pd.read_csv(path))
+
+
+def make_delta(df, seed):
+    """Part rows of 40 existing sets moved 3 years later with more parts, and of 20 sets of a new parent theme."""
+    rng = np.random.default_rng(seed)
+    set_nums = df.set_num.astype(str)
+    changed = df[set_nums.isin(rng.choice(set_nums.unique(), 40, replace=False))].astype(str)
+    changed['year'] = (changed.year.astype(int) + 3).astype(str)
+    changed['num_parts'] = (changed.num_parts.astype(int) + 7).astype(str)
+    added = df[set_nums.isin(rng.choice(set_nums.unique(), 20, replace=False))].astype(str)
+    # The same set_nums in every delta, so later deltas replace the new sets of earlier ones
+    added['set_num'] = 'new-' + added.set_num
+    added['parent_theme_name'] = NEW_THEME
+    added['year'] = str(2017 + seed)
+    return compact_dtypes(pd.concat([changed, added], ignore_index=True))
+
+
+def reload(df, deltas):
+    """Schema of df with the deltas applied to its rows, built from scratch."""
+    df = df.astype(str)
+    for delta in deltas:
+        delta = delta.astype(str)
+        df = pd.concat([df[~df.set_num.isin(delta.set_num)], delta], ignore_index=True)
+    return LegoSchema(compact_dtypes(df))
+
+
+@pytest.fixture(scope='module')
+def schemas(dataset):
+    """The base schema with every index built, and the schemas after one and after two deltas."""
+    base = LegoSchema(dataset, ('v', ()))
+    for index_class in INDEX_CLASSES:
+        base.index(index_class)
+    deltas = [make_delta(dataset, 1), make_delta(dataset, 2)]
+    first = base.with_delta(deltas[0], ('v', ('d1',)))
+    second = first.with_delta(deltas[1], ('v', ('d1', 'd2')))
+    return {'base': base, 'first': first, 'second': second, 'deltas': deltas}
+
+
+def answers(index, min_year, max_year):
+    """What the dashboard reads from index for the year range, in a comparable order."""
+    if isinstance(index, indexes.FirstAppearanceIndex):
+        return [index.counts(min_year, max_year)]
+    if isinstance(index, indexes.ThemeYearIndex):
+        return [index.per_theme(min_year, max_year), index.total(min_year, max_year)]
+    if isinstance(index, indexes.TopSetsIndex):
+        parents = [None, NEW_THEME, 'Parent Theme 0', 'Unknown']
+        return [index.top(min_year, max_year, k, parent).sort_values(['year', 'theme_set']).reset_index(drop=True)
+                for k in (1, 3) for parent in parents]
+    results = [index.ranked(min_year, max_year)]
+    for name in sorted(index.partitions):
+        results.append(index[name].tree(min_year, max_year).sort_values(['theme_name', 'set_name']).reset_index(drop=True))
+        results.append(sorted(index[name].set_ids_between(min_year, max_year)))
+    return results
+
+
+def assert_same(actual, expected):
+    assert len(actual) == len(expected)
+    for a, b in zip(actual, expected):
+        if isinstance(a, pd.DataFrame):
+            pd.testing.assert_frame_equal(a, b)
+        else:
+            assert a == b
+
+
+def brute_force_first_appearances(sets, min_year, max_year):
+    def between(years):
+        return (years >= min_year) & (years <= max_year)
+
+    first_years = {col: sets.groupby(col, observed=True).year.min() for col in ['parent_theme_name', 'theme_name', 'set_name']}
+    parts = sets.groupby(['set_name', 'num_parts'], observed=True).year.min().reset_index()
+    return {'master_themes': int(between(first_years['parent_theme_name']).sum()),
+            'themes': int(between(first_years['theme_name']).sum()),
+            'sets': int(between(first_years['set_name']).sum()),
+            'parts_of_sets': int(parts.num_parts[between(parts.year)].sum())}
+
+
+def brute_force_top_sets(sets, k, parent_theme=None):
+    df = sets[['year', 'parent_theme_name', 'set_name', 'num_parts']].drop_duplicates()
+    df = df.astype({'parent_theme_name': str, 'set_name': str})
+    df['theme_set'] = df.parent_theme_name + ' - ' + df.set_name
+    df = df.groupby(['year', 'parent_theme_name', 'theme_set']).num_parts.sum().reset_index()
+    if parent_theme is not None:
+        df = df[df.parent_theme_name == parent_theme]
+    df['rank'] = df.groupby('year').num_parts.rank(method='dense', ascending=False)
+    return df[df['rank'] <= k].sort_values(['year', 'theme_set']).reset_index(drop=True)
+
+
+@pytest.mark.parametrize('step', ['first', 'second'])
+def test_sets_and_part_rows_match_full_reload(dataset, schemas, step):
+    schema = schemas[step]
+    full = reload(dataset, schemas['deltas'][:1 if step == 'first' else 2])
+
+    def sets(schema):
+        df = schema.sets.drop(columns=['set_id', 'theme_id']).astype(str)
+        return df.sort_values(list(df.columns)).reset_index(drop=True)
+
+    def part_rows(schema):
+        df = schema.part_rows(schema.sets.set_id).drop(columns=['set_id', 'theme_id']).astype(str)
+        return df.sort_values(sorted(df.columns)).reset_index(drop=True)[sorted(df.columns)]
+
+    pd.testing.assert_frame_equal(sets(schema), sets(full))
+    pd.testing.assert_frame_equal(part_rows(schema), part_rows(full))
+
+
+@pytest.mark.parametrize('step', ['first', 'second'])
+@pytest.mark.parametrize('index_class', INDEX_CLASSES, ids=lambda index_class: index_class.__name__)
+def test_updated_index_matches_rebuilt_index(schemas, step, index_class):
+    schema = schemas[step]
+    updated, rebuilt = schema.index(index_class), index_class(schema.sets)
+    for min_year, max_year in YEAR_RANGES:
+        assert_same(answers(updated, min_year, max_year), answers(rebuilt, min_year, max_year))
+
+
+@pytest.mark.parametrize('step', ['base', 'second'])
+def test_first_appearances_match_brute_force(schemas, step):
+    schema = schemas[step]
+    index = schema.index(indexes.FirstAppearanceIndex)
+    for min_year, max_year in YEAR_RANGES:
+        assert index.counts(min_year, max_year) == brute_force_first_appearances(schema.sets, min_year, max_year)
+
+
+@pytest.mark.parametrize('step', ['base', 'second'])
+def test_top_sets_match_brute_force(schemas, step):
+    schema = schemas[step]
+    index = schema.index(indexes.TopSetsIndex)
+    for min_year, max_year in YEAR_RANGES:
+        sets = schema.sets_between(min_year, max_year)
+        for k in (1, 3, 25):
+            for parent_theme in (None, NEW_THEME, 'Parent Theme 0'):
+                top = index.top(min_year, max_year, k, parent_theme).sort_values(['year', 'theme_set']).reset_index(drop=True)
+                expected = brute_force_top_sets(sets, k, parent_theme)
+                pd.testing.assert_frame_equal(top, expected[top.columns], check_dtype=False)
+
+
+def test_with_delta_leaves_previous_schema_unchanged(dataset):
+    base = LegoSchema(dataset, ('v', ()))
+    for index_class in INDEX_CLASSES:
+        base.index(index_class)
+    before = {index_class: answers(base.index(index_class), 1900, 2100) for index_class in INDEX_CLASSES}
+    updated = base.with_delta(make_delta(dataset, 1), ('v', ('d1',)))
+    for index_class in INDEX_CLASSES:
+        assert updated.index(index_class) is not base.index(index_class)
+        assert_same(answers(base.index(index_class), 1900, 2100), before[index_class])
+    assert len(updated.sets) > len(base.sets)
+
+
+def test_merged_categories_stay_sorted(schemas):
+    schema = schemas['second']
+    # The new parent theme sorts first, so it would break the order if it were appended to the categories
+    for col in ['parent_theme_name', 'theme_name', 'set_name', 'set_num']:
+        categories = list(schema.sets[col].cat.categories)
+        assert categories == sorted(categories), col
+    parts = schema.part_rows(schema.sets.set_id)
+    for col in set(CATEGORY_COLUMNS) & set(parts.columns):
+        categories = list(parts[col].cat.categories)
+        assert categories == sorted(categories), col